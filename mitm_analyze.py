@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""Offline analysis of a proxy capture: request rates, upstream latency, register value changes and writes.
+
+    python mitm_analyze.py capture.bin --top 20 --json summary.json --series series/
+
+Works through the capture in chunks of whole blocks, every step is a NumPy array operation over a chunk,
+so memory use depends on --chunk-records and not on the capture size.
+"""
+import argparse
+import json
+import mmap
+import os
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("mitm_analyze.py needs NumPy: pip install numpy")
+
+from mitm_capture import DIR_CLIENT, DIR_UPSTREAM, RECORD_HEADER, capture_start, iter_blocks
+from mitm_image import TABLE_NAMES
+from mitm_metrics import HISTOGRAM_BUCKETS, HISTOGRAM_MIN_BITS
+from modbus_mitm import FUNCTION_CODES, parse_modbus_request
+
+CHUNK_RECORDS = 1 << 18  # records decoded per chunk, a chunk always holds whole blocks
+CARRY_NS = 10_000_000_000  # unanswered requests stay matchable this long into the next chunk
+VERIFY_FRAMES = 64  # requests per chunk cross-checked against parse_modbus_request
+LATENCY_STEPS = 8  # latency buckets per power of two, the proxy's live histograms use 1
+
+RECORD_DTYPE = np.dtype([('ts', '<i8'), ('conn', '<u4'), ('dir', 'u1'), ('pad', 'u1'), ('length', '<u2')])
+assert RECORD_DTYPE.itemsize == RECORD_HEADER.size
+
+# One decoded frame, offset points into the whole capture so carried requests stay valid across chunks
+FRAME_DTYPE = np.dtype([('ts', 'i8'), ('offset', 'i8'), ('conn', 'u4'), ('length', 'u2'), ('tid', 'u2'),
+                        ('address', 'u2'), ('quantity', 'u2'), ('unit', 'u1'), ('fc', 'u1')])
+
+# Read function code -> table index in TABLE_NAMES
+READ_TABLES = {0x01: 0, 0x02: 1, 0x03: 2, 0x04: 3, 0x17: 2}
+COILS, HOLDING_REGISTERS = 0, 2
+
+
+def be16(data, positions):
+    """Big-endian uint16 at each position of data"""
+    positions = np.minimum(positions, len(data) - 2)
+    return (data[positions].astype(np.int32) << 8) | data[positions + 1]
+
+
+def expand(counts):
+    """Return (row, position within row) for counts[row] items per row"""
+    rows = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return rows, np.arange(len(rows)) - np.repeat(starts, counts)
+
+
+def latency_bucket_bound(index):
+    """Upper bound in ns of latency bucket index"""
+    octave, step = divmod(index, LATENCY_STEPS)
+    return (1 << (HISTOGRAM_MIN_BITS + octave - 1)) * (1 + (step + 1) / LATENCY_STEPS)
+
+
+def latency_quantile(buckets, fraction, lowest, highest):
+    """Upper bound in ns of the bucket holding the quantile, buckets is [(index, count)] sorted by index
+
+    Clamped to the observed [lowest, highest] so a quantile never reads outside the samples, e.g. p99 above max.
+    """
+    rank = fraction * sum(count for _, count in buckets)
+    seen = 0
+    for index, count in buckets:
+        seen += count
+        if seen >= rank:
+            return min(max(latency_bucket_bound(index), lowest), highest)
+    return highest
+
+
+def register_keys(unit, table, address):
+    return (unit.astype(np.int64) << 18) | (table.astype(np.int64) << 16) | address.astype(np.int64)
+
+
+def function_keys(unit, fc):
+    return (unit.astype(np.int64) << 8) | fc.astype(np.int64)
+
+
+def group_reduce(keys, columns):
+    """Reduce columns {name: (op, values)} per distinct key, op is sum, min, max, first or last in input order"""
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, np.int64)
+    ends = np.r_[starts[1:], len(keys)] - 1
+    reduced = {}
+    for name, (op, values) in columns.items():
+        values = np.broadcast_to(values, keys.shape)[order]
+        if not len(keys):
+            reduced[name] = values
+        elif op == 'sum':
+            reduced[name] = np.add.reduceat(values, starts)
+        elif op == 'min':
+            reduced[name] = np.minimum.reduceat(values, starts)
+        elif op == 'max':
+            reduced[name] = np.maximum.reduceat(values, starts)
+        elif op == 'first':
+            reduced[name] = values[starts]
+        else:
+            reduced[name] = values[ends]
+    return keys[starts], reduced
+
+
+class Summary:
+    """Per-key columns accumulated over chunks, kept as sorted key array plus one array per column"""
+
+    def __init__(self, **ops):
+        self.ops = ops  # {column: 'sum' | 'min' | 'max' | 'first' | 'last'}
+        self.keys = np.zeros(0, np.int64)
+        self.columns = {name: np.zeros(0) for name in ops}
+
+    def add(self, keys, **values):
+        """Group values by key and merge them, later chunks win for 'last'"""
+        if not len(keys):
+            return
+        keys, reduced = group_reduce(keys, {name: (op, values[name]) for name, op in self.ops.items()})
+        if not len(self.keys):
+            self.keys, self.columns = keys, reduced
+            return
+        merged = np.union1d(self.keys, keys)
+        old = np.searchsorted(merged, self.keys)
+        new = np.searchsorted(merged, keys)
+        seen = np.zeros(len(merged), bool)
+        seen[old] = True
+        seen = seen[new]
+        for name, op in self.ops.items():
+            column = np.zeros(len(merged), np.result_type(self.columns[name], reduced[name]))
+            column[old] = self.columns[name]
+            current, update = column[new], reduced[name]
+            if op == 'sum':
+                column[new] = current + update
+            elif op == 'min':
+                column[new] = np.where(seen, np.minimum(current, update), update)
+            elif op == 'max':
+                column[new] = np.where(seen, np.maximum(current, update), update)
+            elif op == 'first':
+                column[new] = np.where(seen, current, update)
+            else:
+                column[new] = update
+            self.columns[name] = column
+        self.keys = merged
+
+    def lookup(self, keys, name):
+        """Return (found mask, values) of column for keys"""
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        if not len(self.keys):
+            return np.zeros(len(keys), bool), np.zeros(len(keys))
+        found = self.keys[positions] == keys
+        return found, self.columns[name][positions]
+
+
+class CaptureAnalysis:
+    """Streaming aggregates over decoded chunks of one capture"""
+
+    def __init__(self, wall_ns, monotonic_ns, series_dir=None):
+        self.wall_offset = wall_ns - monotonic_ns  # add to record times for wall clock ns
+        self.monotonic_start = monotonic_ns
+        self.series_dir = series_dir
+        self.chunks = 0
+        self.records = {DIR_CLIENT: 0, DIR_UPSTREAM: 0}
+        self.first_ts = None
+        self.last_ts = None
+        self.verify_mismatches = 0
+        self.unmatched_responses = 0
+        self.carry = np.zeros(0, FRAME_DTYPE)  # requests still waiting for a response
+
+        self.requests = Summary(count='sum', bytes='sum')
+        self.request_seconds = Summary(count='sum')  # key: function key << 32 | second of capture
+        self.latency = Summary(count='sum', total='sum', min='min', max='max', exceptions='sum')
+        self.latency_buckets = Summary(count='sum')  # key: function key << 8 | latency bucket
+        self.unanswered = Summary(count='sum')
+        self.registers = Summary(samples='sum', changes='sum', intervals='sum', rate_sum='sum', rate_max='max',
+                                 minimum='min', maximum='max', first_ts='first', last_ts='last', last_value='last')
+        self.writes = Summary(count='sum', first_ts='first', last_ts='last', last_value='last')
+
+    def add_chunk(self, data, headers, offsets):
+        frames = self.decode(data, headers, offsets)
+        if not len(frames):
+            return
+        self.first_ts = frames['ts'].min() if self.first_ts is None else min(self.first_ts, frames['ts'].min())
+        self.last_ts = frames['ts'].max() if self.last_ts is None else max(self.last_ts, frames['ts'].max())
+
+        is_request = headers['dir'] == DIR_CLIENT
+        requests, responses = frames[is_request], frames[~is_request]
+        self.records[DIR_CLIENT] += len(requests)
+        self.records[DIR_UPSTREAM] += len(responses)
+        self.verify(data, requests[:VERIFY_FRAMES])
+
+        function = function_keys(requests['unit'], requests['fc'])
+        self.requests.add(function, count=1, bytes=requests['length'].astype(np.int64))
+        seconds = (requests['ts'] - self.monotonic_start) // 1_000_000_000
+        self.request_seconds.add((function << 32) | seconds, count=1)
+
+        pending = np.concatenate([self.carry, requests])
+        request_index, response_index = self.match(pending, responses)
+        self.add_latency(pending[request_index], responses[response_index])
+
+        answered = np.zeros(len(pending), bool)
+        answered[request_index] = True
+        waiting = pending[~answered]
+        expired = waiting['ts'] < self.last_ts - CARRY_NS
+        self.unanswered.add(function_keys(waiting['unit'][expired], waiting['fc'][expired]), count=1)
+        self.carry = waiting[~expired]
+        self.unmatched_responses += len(responses) - len(response_index)
+
+        reads = self.read_values(data, pending[request_index], responses[response_index])
+        writes = self.write_values(data, requests)
+        self.add_register_changes(*reads)
+        ts, unit, table, address, value = writes
+        self.writes.add(register_keys(unit, table, address), count=1, first_ts=ts, last_ts=ts, last_value=value)
+        if self.series_dir:
+            self.write_series(reads, writes)
+        self.chunks += 1
+
+    def decode(self, data, headers, offsets):
+        """Pull MBAP header and the address/quantity words out of every frame at once"""
+        frames = np.zeros(len(headers), FRAME_DTYPE)
+        frames['ts'] = headers['ts']
+        frames['conn'] = headers['conn']
+        frames['length'] = headers['length']
+        frames['offset'] = offsets
+        frames['tid'] = be16(data, offsets)
+        frames['unit'] = data[np.minimum(offsets + 6, len(data) - 1)]
+        frames['fc'] = data[np.minimum(offsets + 7, len(data) - 1)]
+        long_enough = headers['length'] >= 12
+        frames['address'] = np.where(long_enough, be16(data, offsets + 8), 0)
+        frames['quantity'] = np.where(long_enough, be16(data, offsets + 10), 0)
+        return frames
+
+    def verify(self, data, requests):
+        """Decode a sample with parse_modbus_request, the reference the array decoding must agree with"""
+        for frame in requests:
+            offset = int(frame['offset'])
+            request = parse_modbus_request(bytes(data[offset:offset + int(frame['length'])]))
+            if request is None or request.address is None:
+                continue
+            if (request.function_code, request.unit_id, request.address) != \
+                    (frame['fc'], frame['unit'], frame['address']):
+                self.verify_mismatches += 1
+
+    def match(self, requests, responses):
+        """Pair responses with requests of the same connection and transaction id, oldest request first.
+
+        Like the proxy, every (conn, tid) is a FIFO: the k-th answered response of a key takes its k-th
+        request, so masters pipelining one reused id are paired correctly. A response arriving while its key
+        has nothing outstanding stays unmatched and does not shift later pairs.
+        """
+        keys = np.concatenate([(requests['conn'].astype(np.int64) << 16) | requests['tid'],
+                               (responses['conn'].astype(np.int64) << 16) | responses['tid']])
+        times = np.concatenate([requests['ts'], responses['ts']])
+        kinds = np.concatenate([np.zeros(len(requests), np.int8), np.ones(len(responses), np.int8)])
+        index = np.concatenate([np.arange(len(requests)), np.arange(len(responses))])
+        order = np.lexsort((kinds, times, keys))
+        keys, kinds, index = keys[order], kinds[order], index[order]
+        if not len(keys):
+            return index, index
+
+        # Running counts within each key group: cumulative sums minus the sum before the group started
+        starts = np.r_[True, keys[1:] != keys[:-1]]
+        group = np.cumsum(starts) - 1
+        is_request = kinds == 0
+        requests_seen = np.cumsum(is_request)
+        responses_seen = np.cumsum(~is_request)
+        requests_seen -= (requests_seen - is_request)[starts][group]
+        responses_seen -= (responses_seen - ~is_request)[starts][group]
+
+        # Responses beyond the outstanding requests are unmatched: their number so far is the deepest the
+        # balance requests - responses has dipped below zero. Offsetting each group far below the previous
+        # ones restarts the running minimum per group.
+        span = 2 * len(keys) + 2
+        balance = requests_seen - responses_seen - group * span
+        unmatched = np.maximum(0, -(np.minimum.accumulate(balance) + group * span))
+        unmatched_before = np.where(starts, 0, np.r_[0, unmatched[:-1]])
+        answered = ~is_request & (unmatched == unmatched_before)
+
+        # The r-th answered response of a group takes the group's r-th request
+        request_ranks = group[is_request] * span + requests_seen[is_request] - 1
+        response_ranks = group[answered] * span + responses_seen[answered] - unmatched[answered] - 1
+        position = np.searchsorted(request_ranks, response_ranks)
+        return index[is_request][position], index[answered]
+
+    def add_latency(self, requests, responses):
+        latency = responses['ts'] - requests['ts']
+        function = function_keys(requests['unit'], requests['fc'])
+        exceptions = (responses['fc'] & 0x80) != 0
+        self.latency.add(function, count=1, total=latency, min=latency, max=latency,
+                         exceptions=exceptions.astype(np.int64))
+        # Octaves as in the proxy's live histograms (frexp exponent is the bit length), split in LATENCY_STEPS
+        mantissa, exponent = np.frexp(np.maximum(latency, 1).astype(np.float64))
+        bucket = ((exponent - HISTOGRAM_MIN_BITS) * LATENCY_STEPS
+                  + ((mantissa - 0.5) * 2 * LATENCY_STEPS).astype(np.int64))
+        bucket = np.clip(bucket, 0, HISTOGRAM_BUCKETS * LATENCY_STEPS - 1)
+        self.latency_buckets.add((function << 8) | bucket, count=1)
+
+    def read_values(self, data, requests, responses):
+        """Expand read responses into per-address rows: (ts, unit, table, address, value)"""
+        fc = requests['fc']
+        quantity = requests['quantity'].astype(np.int64)
+        byte_count = data[np.minimum(responses['offset'] + 8, len(data) - 1)].astype(np.int64)
+        is_register = (fc == 0x03) | (fc == 0x04) | (fc == 0x17)
+        is_bit = (fc == 0x01) | (fc == 0x02)
+        expected = np.where(is_register, quantity * 2, (quantity + 7) // 8)
+        valid = ((is_register | is_bit) & (responses['fc'] == fc) & (quantity > 0) & (byte_count == expected)
+                 & (responses['length'] >= 9 + byte_count))
+        requests, responses, quantity, is_register = requests[valid], responses[valid], quantity[valid], \
+            is_register[valid]
+
+        rows, within = expand(quantity)
+        base = responses['offset'][rows] + 9
+        register = is_register[rows]
+        bit = (data[base + (within >> 3)] >> (within & 7)) & 1
+        value = np.where(register, be16(data, base + 2 * within), bit)
+        table = np.zeros(len(rows), np.int64)
+        for function_code, index in READ_TABLES.items():
+            table[requests['fc'][rows] == function_code] = index
+        address = requests['address'][rows].astype(np.int64) + within
+        keep = address <= 0xFFFF
+        return (responses['ts'][rows][keep], requests['unit'][rows][keep], table[keep], address[keep],
+                value[keep].astype(np.int64))
+
+    def write_values(self, data, requests):
+        """Expand client write requests into per-address rows: (ts, unit, table, address, value)"""
+        fc = requests['fc']
+        length = requests['length'].astype(np.int64)
+        offset = requests['offset']
+        parts = []
+
+        # WRITE SINGLE COIL/REGISTER (05, 06) and MASK WRITE REGISTER (16, resulting value unknown: -1)
+        single = ((fc == 0x05) | (fc == 0x06) | (fc == 0x16)) & (length >= 12)
+        value = requests['quantity'].astype(np.int64)  # second word is the value for 05/06
+        value = np.where(fc == 0x05, (value == 0xFF00).astype(np.int64), np.where(fc == 0x16, -1, value))
+        table = np.where(fc == 0x05, COILS, HOLDING_REGISTERS)
+        parts.append((requests['ts'][single], requests['unit'][single], table[single],
+                      requests['address'][single].astype(np.int64), value[single]))
+
+        # WRITE MULTIPLE COILS/REGISTERS (0F, 10) and write half of READ/WRITE MULTIPLE REGISTERS (17)
+        is_rw = fc == 0x17
+        address = np.where(is_rw, be16(data, offset + 12), requests['address']).astype(np.int64)
+        quantity = np.where(is_rw, be16(data, offset + 14), requests['quantity']).astype(np.int64)
+        data_offset = np.where(is_rw, 17, 13)
+        byte_count = data[np.minimum(offset + data_offset - 1, len(data) - 1)].astype(np.int64)
+        expected = np.where(fc == 0x0F, (quantity + 7) // 8, quantity * 2)
+        multiple = (((fc == 0x0F) | (fc == 0x10) | is_rw) & (quantity > 0) & (byte_count == expected)
+                    & (length >= data_offset + byte_count))
+        rows, within = expand(quantity[multiple])
+        base = (offset + data_offset)[multiple][rows]
+        coil = (fc[multiple] == 0x0F)[rows]
+        bit = (data[base + (within >> 3)] >> (within & 7)) & 1
+        value = np.where(coil, bit, be16(data, base + 2 * within)).astype(np.int64)
+        address = address[multiple][rows] + within
+        keep = address <= 0xFFFF
+        parts.append((requests['ts'][multiple][rows][keep], requests['unit'][multiple][rows][keep],
+                      np.where(coil, COILS, HOLDING_REGISTERS)[keep], address[keep], value[keep]))
+
+        return tuple(np.concatenate([part[i] for part in parts]) for i in range(5))
+
+    def add_register_changes(self, ts, unit, table, address, value):
+        """Per-register samples, changes and rate of change, continuing from the previous chunk's last value"""
+        if not len(ts):
+            return
+        keys = register_keys(unit, table, address)
+        previous_keys = np.unique(keys)
+        found, previous_ts = self.registers.lookup(previous_keys, 'last_ts')
+        _, previous_value = self.registers.lookup(previous_keys, 'last_value')
+        previous_keys = previous_keys[found]
+
+        carried = np.r_[np.ones(len(previous_keys), bool), np.zeros(len(keys), bool)]
+        keys = np.r_[previous_keys, keys]
+        ts = np.r_[previous_ts[found].astype(np.int64), ts]
+        value = np.r_[previous_value[found].astype(np.int64), value]
+        order = np.lexsort((ts, keys))
+        keys, ts, value, carried = keys[order], ts[order], value[order], carried[order]
+
+        same = np.r_[False, keys[1:] == keys[:-1]]
+        elapsed = np.r_[0, np.diff(ts)] / 1e9
+        change = np.abs(np.r_[0, np.diff(value)])
+        interval = same & (elapsed > 0)
+        rate = np.where(interval, change / np.where(interval, elapsed, 1), 0.0)
+
+        sample = ~carried
+        self.registers.add(keys[sample], samples=1, changes=(same & (change != 0))[sample].astype(np.int64),
+                           intervals=interval[sample].astype(np.int64), rate_sum=rate[sample],
+                           rate_max=rate[sample], minimum=value[sample], maximum=value[sample],
+                           first_ts=ts[sample], last_ts=ts[sample], last_value=value[sample])
+
+    def write_series(self, reads, writes):
+        """Columnar per-address time series of this chunk, wall clock ns"""
+        columns = {}
+        for prefix, rows in (('read', reads), ('write', writes)):
+            ts, unit, table, address, value = rows
+            columns.update({f'{prefix}_ts': ts + self.wall_offset, f'{prefix}_unit': unit.astype(np.uint8),
+                            f'{prefix}_table': table.astype(np.uint8), f'{prefix}_address': address.astype(np.uint16),
+                            f'{prefix}_value': value.astype(np.int32)})
+        np.savez(os.path.join(self.series_dir, f"series-{self.chunks:06d}.npz"), **columns)
+
+    def finish(self):
+        """Requests still waiting at the end of the capture were never answered"""
+        self.unanswered.add(function_keys(self.carry['unit'], self.carry['fc']), count=1)
+        self.carry = self.carry[:0]
+
+    def summary(self, top):
+        duration = (self.last_ts - self.first_ts) / 1e9 if self.first_ts is not None else 0.0
+
+        peak_keys, peaks = group_reduce(self.request_seconds.keys >> 32,
+                                        {'peak': ('max', self.request_seconds.columns['count'])})
+        peak_by_key = dict(zip(peak_keys.tolist(), peaks['peak'].tolist()))
+        requests = []
+        for key, count, size in zip(self.requests.keys.tolist(), self.requests.columns['count'].tolist(),
+                                    self.requests.columns['bytes'].tolist()):
+            requests.append({'unit': key >> 8, 'fc': key & 0xFF, 'name': FUNCTION_CODES.get(key & 0xFF, "UNKNOWN"),
+                             'count': count, 'bytes': size, 'rate': count / duration if duration else 0.0,
+                             'peak_rate': peak_by_key.get(key, 0)})
+
+        histograms = {}
+        for key, count in zip(self.latency_buckets.keys.tolist(), self.latency_buckets.columns['count'].tolist()):
+            histograms.setdefault(key >> 8, []).append((key & 0xFF, count))
+        unanswered = dict(zip(self.unanswered.keys.tolist(), self.unanswered.columns['count'].tolist()))
+        latency = []
+        columns = self.latency.columns
+        for i, key in enumerate(self.latency.keys.tolist()):
+            count = int(columns['count'][i])
+            histogram = histograms[key]
+            lowest, highest = float(columns['min'][i]), float(columns['max'][i])
+            latency.append({'unit': key >> 8, 'fc': key & 0xFF, 'name': FUNCTION_CODES.get(key & 0xFF, "UNKNOWN"),
+                            'count': count, 'exceptions': int(columns['exceptions'][i]),
+                            'unanswered': unanswered.pop(key, 0),
+                            'mean_us': columns['total'][i] / count / 1e3, 'min_us': lowest / 1e3,
+                            'p50_us': latency_quantile(histogram, 0.5, lowest, highest) / 1e3,
+                            'p95_us': latency_quantile(histogram, 0.95, lowest, highest) / 1e3,
+                            'p99_us': latency_quantile(histogram, 0.99, lowest, highest) / 1e3,
+                            'max_us': highest / 1e3})
+        for key, count in unanswered.items():
+            latency.append({'unit': key >> 8, 'fc': key & 0xFF, 'name': FUNCTION_CODES.get(key & 0xFF, "UNKNOWN"),
+                            'count': 0, 'exceptions': 0, 'unanswered': count})
+
+        return {
+            'records': {'client': self.records[DIR_CLIENT], 'upstream': self.records[DIR_UPSTREAM]},
+            'chunks': self.chunks,
+            'start': (self.first_ts + self.wall_offset) / 1e9 if self.first_ts is not None else None,
+            'duration_s': duration,
+            'unmatched_responses': self.unmatched_responses,
+            'verify_mismatches': self.verify_mismatches,
+            'requests': requests,
+            'latency': latency,
+            'registers': self.top_registers(top),
+            'writes': self.top_writes(top, duration),
+        }
+
+    def top_registers(self, top):
+        """Registers with the fastest value changes"""
+        columns = self.registers.columns
+        mean_rate = columns['rate_sum'] / np.maximum(columns['intervals'], 1)
+        order = np.lexsort((-columns['changes'], -columns['rate_max']))[:top]
+        return [{'unit': int(key >> 18), 'table': TABLE_NAMES[(key >> 16) & 3], 'address': int(key & 0xFFFF),
+                 'samples': int(columns['samples'][i]), 'changes': int(columns['changes'][i]),
+                 'min': int(columns['minimum'][i]), 'max': int(columns['maximum'][i]),
+                 'last': int(columns['last_value'][i]), 'mean_rate': float(mean_rate[i]),
+                 'max_rate': float(columns['rate_max'][i])}
+                for key, i in zip(self.registers.keys[order].tolist(), order.tolist())]
+
+    def top_writes(self, top, duration):
+        """Most frequently written registers and coils"""
+        columns = self.writes.columns
+        order = np.argsort(-columns['count'], kind='stable')[:top]
+        return [{'unit': int(key >> 18), 'table': TABLE_NAMES[(key >> 16) & 3], 'address': int(key & 0xFFFF),
+                 'writes': int(columns['count'][i]),
+                 'per_minute': float(columns['count'][i]) * 60 / duration if duration else 0.0,
+                 'last': int(columns['last_value'][i])}
+                for key, i in zip(self.writes.keys[order].tolist(), order.tolist())]
+
+
+def iter_chunks(buffer, chunk_records):
+    """Yield (record headers, payload offsets) for runs of whole blocks holding about chunk_records records"""
+    headers, offsets, count = [], [], 0
+    for block_count, headers_offset, payloads_offset in iter_blocks(buffer):
+        block = np.frombuffer(buffer, RECORD_DTYPE, block_count, headers_offset)
+        lengths = block['length'].astype(np.int64)
+        headers.append(block)
+        offsets.append(payloads_offset + np.cumsum(lengths) - lengths)
+        count += block_count
+        if count >= chunk_records:
+            yield np.concatenate(headers), np.concatenate(offsets)
+            headers, offsets, count = [], [], 0
+    if count:
+        yield np.concatenate(headers), np.concatenate(offsets)
+
+
+def analyze(path, chunk_records=CHUNK_RECORDS, series_dir=None, top=20):
+    """Stream capture at path through CaptureAnalysis and return its summary"""
+    if series_dir:
+        os.makedirs(series_dir, exist_ok=True)
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    analysis = CaptureAnalysis(*capture_start(buffer), series_dir)
+    data = np.frombuffer(buffer, np.uint8)
+    try:
+        for headers, offsets in iter_chunks(buffer, chunk_records):
+            analysis.add_chunk(data, headers, offsets)
+        analysis.finish()
+        return analysis.summary(top)
+    finally:
+        del data
+        try:
+            buffer.close()
+        except BufferError:
+            pass  # an array view is still alive, the mapping goes away with it
+
+
+def print_report(summary):
+    records = summary['records']
+    print(f"{records['client']} requests, {records['upstream']} responses over {summary['duration_s']:.1f}s "
+          f"in {summary['chunks']} chunks, {summary['unmatched_responses']} unmatched responses")
+    if summary['verify_mismatches']:
+        print(f"WARNING: {summary['verify_mismatches']} sampled frames decoded differently by parse_modbus_request")
+
+    print(f"\n{'unit':>4} {'fc':>4} {'function':<32} {'requests':>9} {'req/s':>9} {'peak/s':>7} {'bytes':>10}")
+    for r in summary['requests']:
+        print(f"{r['unit']:>4} 0x{r['fc']:02X} {r['name']:<32} {r['count']:>9} {r['rate']:>9.1f} "
+              f"{r['peak_rate']:>7} {r['bytes']:>10}")
+
+    print(f"\nUpstream latency (us)\n{'unit':>4} {'fc':>4} {'answered':>9} {'exc':>5} {'lost':>5} {'min':>8} "
+          f"{'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>9}")
+    for r in summary['latency']:
+        if not r['count']:
+            print(f"{r['unit']:>4} 0x{r['fc']:02X} {0:>9} {0:>5} {r['unanswered']:>5}")
+            continue
+        print(f"{r['unit']:>4} 0x{r['fc']:02X} {r['count']:>9} {r['exceptions']:>5} {r['unanswered']:>5} "
+              f"{r['min_us']:>8.1f} {r['mean_us']:>8.1f} {r['p50_us']:>8.1f} {r['p95_us']:>8.1f} "
+              f"{r['p99_us']:>8.1f} {r['max_us']:>9.1f}")
+
+    print(f"\nFastest changing values\n{'unit':>4} {'table':<18} {'addr':>6} {'samples':>8} {'changes':>8} "
+          f"{'min':>6} {'max':>6} {'last':>6} {'mean/s':>9} {'max/s':>9}")
+    for r in summary['registers']:
+        print(f"{r['unit']:>4} {r['table']:<18} {r['address']:>6} {r['samples']:>8} {r['changes']:>8} "
+              f"{r['min']:>6} {r['max']:>6} {r['last']:>6} {r['mean_rate']:>9.1f} {r['max_rate']:>9.1f}")
+
+    print(f"\nMost written\n{'unit':>4} {'table':<18} {'addr':>6} {'writes':>8} {'per min':>9} {'last':>6}")
+    for r in summary['writes']:
+        print(f"{r['unit']:>4} {r['table']:<18} {r['address']:>6} {r['writes']:>8} {r['per_minute']:>9.1f} "
+              f"{r['last']:>6}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze a Modbus MITM capture")
+    parser.add_argument('capture', help="capture file written with modbus_mitm.py --capture")
+    parser.add_argument('--chunk-records', type=int, default=CHUNK_RECORDS,
+                        help="records decoded per step, bounds memory use")
+    parser.add_argument('--top', type=int, default=20, help="registers listed per table")
+    parser.add_argument('--json', metavar='FILE', help="also write the summary as JSON")
+    parser.add_argument('--series', metavar='DIR',
+                        help="write per-address read and write time series as one .npz per chunk")
+    args = parser.parse_args(argv)
+
+    try:
+        summary = analyze(args.capture, args.chunk_records, args.series, args.top)
+    except (OSError, ValueError) as e:
+        sys.exit(f"mitm_analyze: {e}")
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2, default=float)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark: client sessions against a stand-in Modbus server, directly and through modbus_mitm.
+
+    python mitm_bench.py --sessions 8 --duration 10 --mix 3=80,6=15,10=5
+    python mitm_bench.py --modes proxy,nagle --variant nagle=--no-tcp-nodelay --pipeline 4
+    python mitm_bench.py serve --server-port 1502    # stand-in server only, e.g. for mitm_replay.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from modbus_mitm import MBAP_HEADER, UINT16_PAIR, MBAPReassembler
+
+REGISTER_COUNT = 65536
+
+
+class StandInServer:
+    """Minimal Modbus TCP server keeping one holding/input register table, answers 03/04/06/10"""
+
+    def __init__(self, host='127.0.0.1', port=1502):
+        self.host = host
+        self.port = port
+        self.registers = [0] * REGISTER_COUNT
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    def respond(self, frame):
+        transaction_id, _, _, unit_id, function_code = MBAP_HEADER.unpack_from(frame)
+        if function_code in (0x03, 0x04) and len(frame) >= 12:
+            address, quantity = UINT16_PAIR.unpack_from(frame, 8)
+            values = self.registers[address:address + quantity]
+            pdu = struct.pack(f'>BB{len(values)}H', function_code, len(values) * 2, *values)
+        elif function_code == 0x06 and len(frame) >= 12:
+            address, value = UINT16_PAIR.unpack_from(frame, 8)
+            self.registers[address] = value
+            pdu = frame[7:12]
+        elif function_code == 0x10 and len(frame) >= 13:
+            address, quantity = UINT16_PAIR.unpack_from(frame, 8)
+            values = struct.unpack_from(f'>{quantity}H', frame, 13)
+            self.registers[address:address + len(values)] = values
+            pdu = frame[7:12]
+        else:
+            pdu = bytes((function_code | 0x80, 0x01))  # ILLEGAL FUNCTION
+        return MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 1, unit_id, pdu[0]) + pdu[1:]
+
+    async def handle(self, reader, writer):
+        reassembler = MBAPReassembler()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                writer.writelines([self.respond(frame) for frame in reassembler.feed(data)])
+                await writer.drain()
+        except (OSError, ValueError, struct.error):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True)
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def start(self):
+        """Serve from a background thread"""
+        self.thread = threading.Thread(target=self.run, name="stand-in-server", daemon=True)
+        self.thread.start()
+        self.ready.wait(5)
+
+    def stop(self):
+        for task in asyncio.all_tasks(self.loop):
+            self.loop.call_soon_threadsafe(task.cancel)
+        self.thread.join(5)
+
+
+def parse_mix(text):
+    """Parse '3=80,6=15,10=5' into ([function codes], [weights])"""
+    codes, weights = [], []
+    for item in text.split(','):
+        function_code, weight = item.split('=')
+        function_code = int(function_code, 16)
+        if function_code not in (0x03, 0x06, 0x10):
+            raise ValueError(f"unsupported function code 0x{function_code:02X} in mix")
+        codes.append(function_code)
+        weights.append(float(weight))
+    return codes, weights
+
+
+def build_request(transaction_id, function_code, address, count):
+    if function_code == 0x03:
+        pdu = UINT16_PAIR.pack(address, count)
+    elif function_code == 0x06:
+        pdu = UINT16_PAIR.pack(address, transaction_id)
+    else:
+        pdu = struct.pack(f'>HHB{count}H', address, count, count * 2, *([transaction_id] * count))
+    return MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 2, 1, function_code) + pdu
+
+
+async def client_session(host, port, codes, weights, count, address_range, deadline, warmup_until,
+                         latencies, seed, pipeline=1):
+    """Issue batches of pipeline requests until deadline, append round-trip ns to latencies
+
+    Requests of a batch are written one by one, as separate small sends, and each response is timed from
+    the start of its batch, so delayed coalescing (Nagle, delayed ACK) on the path shows up in the tail.
+    """
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reassembler = MBAPReassembler()
+    transaction_id = 0
+    errors = 0
+    try:
+        while time.monotonic() < deadline:
+            requests = []
+            for _ in range(pipeline):
+                transaction_id = (transaction_id + 1) & 0xFFFF
+                function_code = rng.choices(codes, weights)[0]
+                requests.append(build_request(transaction_id, function_code, rng.randrange(address_range), count))
+
+            started = time.perf_counter_ns()
+            for request in requests:
+                writer.write(request)
+                await writer.drain()
+            outstanding = pipeline
+            while outstanding:
+                data = await reader.read(4096)
+                if not data:
+                    return errors + 1
+                elapsed = time.perf_counter_ns() - started
+                measured = time.monotonic() >= warmup_until
+                for frame in reassembler.feed(data):
+                    outstanding -= 1
+                    if frame[7] & 0x80:
+                        errors += 1
+                    elif measured:
+                        latencies.append(elapsed)
+    finally:
+        writer.close()
+    return errors
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def process_usage(pid):
+    """Return (cpu seconds, peak RSS bytes) of pid from /proc, or (None, None)"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return cpu, int(line.split()[1]) * 1024
+        return cpu, None
+    except (OSError, IndexError, ValueError):
+        return None, None
+
+
+def is_listening(port):
+    """Check /proc/net/tcp for a listener on port without opening a connection through it"""
+    with open('/proc/net/tcp') as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            if fields[3] == '0A' and int(fields[1].rsplit(':', 1)[1], 16) == port:  # 0A = LISTEN
+                return True
+    return False
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if is_listening(port):
+                return True
+        except OSError:
+            # No procfs, fall back to a probe connection
+            try:
+                socket.create_connection((host, port), 0.2).close()
+                return True
+            except OSError:
+                pass
+        time.sleep(0.05)
+    return False
+
+
+def start_proxy(args, extra=()):
+    """Spawn modbus_mitm in front of the stand-in server, extra arguments after the --proxy-arg ones"""
+    # One upstream source port per session, with room for uneven spreading over workers
+    last_port = args.source_port_base + 2 * args.sessions + 7
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modbus_mitm.py'),
+               '--listen-host', args.host, '--listen-port', str(args.proxy_port),
+               '--upstream-host', args.host, '--upstream-port', str(args.server_port),
+               '--source-ports', f'{args.source_port_base}-{last_port}',
+               '--log-level', 'warning'] + args.proxy_arg + list(extra)
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL if not args.verbose else None)
+    if not wait_for_port(args.host, args.proxy_port):
+        proxy.kill()
+        raise RuntimeError("proxy did not start listening")
+    return proxy
+
+
+def run_mode(name, port, args, codes, weights, proxy=None):
+    """Run all client sessions against port, return result dict"""
+    latencies = []
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    proxy_cpu_before = process_usage(proxy.pid)[0] if proxy else None
+
+    async def run_sessions():
+        now = time.monotonic()
+        deadline = now + args.warmup + args.duration
+        return await asyncio.gather(*(
+            client_session(args.host, port, codes, weights, args.registers, args.address_range,
+                           deadline, now + args.warmup, latencies, args.seed + i, args.pipeline)
+            for i in range(args.sessions)
+        ), return_exceptions=True)
+
+    outcomes = asyncio.run(run_sessions())
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    errors = 0
+    failed_sessions = 0
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            failed_sessions += 1
+        else:
+            errors += outcome
+
+    latencies.sort()
+    result = {
+        'mode': name,
+        'transactions': len(latencies),
+        'tps': len(latencies) / args.duration,
+        'p50_us': percentile(latencies, 0.50) / 1000,
+        'p95_us': percentile(latencies, 0.95) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'max_us': (latencies[-1] if latencies else 0) / 1000,
+        'errors': errors,
+        'failed_sessions': failed_sessions,
+        'harness_cpu_s': (usage_after.ru_utime + usage_after.ru_stime
+                          - usage_before.ru_utime - usage_before.ru_stime),
+        'proxy_cpu_s': None,
+        'proxy_rss_mb': None,
+    }
+    if proxy:
+        proxy_cpu, proxy_rss = process_usage(proxy.pid)
+        if proxy_cpu is not None and proxy_cpu_before is not None:
+            result['proxy_cpu_s'] = proxy_cpu - proxy_cpu_before
+        if proxy_rss is not None:
+            result['proxy_rss_mb'] = proxy_rss / (1 << 20)
+    return result
+
+
+def format_optional(value, spec, unit):
+    return "n/a" if value is None else format(value, spec) + unit
+
+
+def print_report(results):
+    print(f"{'mode':<10} {'tx':>9} {'tx/s':>9} {'p50us':>8} {'p95us':>8} {'p99us':>8} {'maxus':>9} "
+          f"{'err':>5} {'harness cpu':>11} {'proxy cpu':>9} {'proxy rss':>9}")
+    for r in results:
+        print(f"{r['mode']:<10} {r['transactions']:>9} {r['tps']:>9.0f} {r['p50_us']:>8.1f} {r['p95_us']:>8.1f} "
+              f"{r['p99_us']:>8.1f} {r['max_us']:>9.1f} {r['errors'] + r['failed_sessions']:>5} "
+              f"{r['harness_cpu_s']:>10.2f}s {format_optional(r['proxy_cpu_s'], '.2f', 's'):>9} "
+              f"{format_optional(r['proxy_rss_mb'], '.1f', 'MB'):>9}")
+
+    direct = next((r for r in results if r['mode'] == 'direct'), None)
+    if direct:
+        for r in results:
+            if r is direct:
+                continue
+            print(f"\nProxy-added latency ({r['mode']}): "
+                  f"p50 {r['p50_us'] - direct['p50_us']:+.1f}us, p95 {r['p95_us'] - direct['p95_us']:+.1f}us, "
+                  f"p99 {r['p99_us'] - direct['p99_us']:+.1f}us, max {r['max_us'] - direct['max_us']:+.1f}us")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark modbus_mitm against a stand-in Modbus server")
+    parser.add_argument('command', nargs='?', choices=('run', 'serve'), default='run')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--server-port', type=int, default=15020, help="stand-in server port")
+    parser.add_argument('--proxy-port', type=int, default=15021, help="proxy listening port")
+    parser.add_argument('--sessions', type=int, default=8, help="concurrent client sessions")
+    parser.add_argument('--source-port-base', type=int, default=30000,
+                        help="first upstream source port of the proxy, away from the mitm_iptables.sh range "
+                             "and below the ephemeral ports")
+    parser.add_argument('--duration', type=float, default=10.0, help="measured seconds per mode")
+    parser.add_argument('--warmup', type=float, default=1.0, help="unmeasured seconds before each mode")
+    parser.add_argument('--mix', default='3=80,6=15,10=5',
+                        help="hex function code=weight list, codes 03, 06 and 10")
+    parser.add_argument('--registers', type=int, default=10, help="registers per 03/10 request")
+    parser.add_argument('--address-range', type=int, default=100, help="random start address below this")
+    parser.add_argument('--pipeline', type=int, default=1, help="requests in flight per session")
+    parser.add_argument('--modes', default='direct,proxy', help="comma list of direct, proxy and variant names")
+    parser.add_argument('--proxy-arg', action='append', default=[],
+                        help="extra argument passed to modbus_mitm.py (repeatable)")
+    parser.add_argument('--variant', action='append', default=[], metavar='NAME=ARGS',
+                        help="proxy mode NAME run with the extra space separated modbus_mitm.py ARGS (repeatable)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='FILE', help="also write results as JSON")
+    parser.add_argument('--verbose', action='store_true', help="show proxy output")
+    args = parser.parse_args(argv)
+    if not 1 <= args.registers <= 123:
+        parser.error("--registers must be 1..123")
+    try:
+        args.codes, args.weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(f"invalid --mix: {e}")
+    if args.sessions < 1 or args.source_port_base + 2 * args.sessions + 7 > 65535:
+        parser.error("--sessions must be at least 1 and fit above --source-port-base")
+    if args.pipeline < 1:
+        parser.error("--pipeline must be at least 1")
+    args.variants = {'proxy': []}
+    for variant in args.variant:
+        name, separator, extra = variant.partition('=')
+        if not separator or not name or name == 'direct':
+            parser.error(f"invalid --variant {variant!r}, expected NAME=ARGS")
+        args.variants[name] = extra.split()
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = StandInServer(args.host, args.server_port)
+
+    if args.command == 'serve':
+        print(f"Stand-in Modbus server on {args.host}:{args.server_port}, Ctrl+C to stop")
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    server.start()
+    results = []
+    try:
+        for mode in args.modes.split(','):
+            if mode == 'direct':
+                results.append(run_mode('direct', args.server_port, args, args.codes, args.weights))
+            elif mode in args.variants:
+                proxy = start_proxy(args, args.variants[mode])
+                try:
+                    results.append(run_mode(mode, args.proxy_port, args, args.codes, args.weights, proxy))
+                finally:
+                    proxy.terminate()
+                    proxy.wait()
+            else:
+                raise SystemExit(f"unknown mode {mode!r}")
+    finally:
+        server.stop()
+
+    print(f"{args.sessions} sessions, {args.duration:.0f}s per mode, mix {args.mix}, "
+          f"{args.registers} registers per 03/10 request, pipeline {args.pipeline}\n")
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
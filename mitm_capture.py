@@ -0,0 +1,121 @@
+import mmap
+import struct
+import threading
+import time
+
+# File layout:
+#   file header   magic, wall clock ns and monotonic ns at open (maps record times to wall time)
+#   blocks        block header (record count, payload bytes), record headers, then frame payloads
+# Record headers are fixed size and stored together so a block can be indexed without walking frames.
+CAPTURE_MAGIC = b'MBCAP001'
+FILE_HEADER = struct.Struct('<8sqq')
+BLOCK_MAGIC = b'BLK\x00'
+BLOCK_HEADER = struct.Struct('<4sII')  # magic, record count, payload bytes
+RECORD_HEADER = struct.Struct('<qIBxH')  # monotonic ns, connection id, direction, frame length
+
+DIR_CLIENT = 0  # client -> proxy, as received before any rewrite
+DIR_UPSTREAM = 1  # upstream -> proxy, as received before any restore
+DIRECTION_NAMES = {DIR_CLIENT: "client", DIR_UPSTREAM: "upstream"}
+
+
+class CaptureWriter:
+    """Append-only capture file, records are buffered in memory and written in blocks by a thread"""
+
+    def __init__(self, path, flush_interval=0.5, block_bytes=1 << 20, max_buffered=64 << 20, exclusive=False):
+        self.path = path
+        self.file = open(path, 'xb' if exclusive else 'wb')  # exclusive: never truncate another writer's file
+        self.file.write(FILE_HEADER.pack(CAPTURE_MAGIC, time.time_ns(), time.monotonic_ns()))
+        self.flush_interval = flush_interval
+        self.block_bytes = block_bytes
+        self.max_buffered = max_buffered
+        self.lock = threading.Lock()
+        self.headers = bytearray()
+        self.payloads = bytearray()
+        self.count = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.flusher, name="capture-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, conn_id, direction, frame):
+        """Buffer one frame, never waits on disk"""
+        with self.lock:
+            if len(self.payloads) >= self.max_buffered:
+                self.dropped += 1
+                return
+            self.headers += RECORD_HEADER.pack(time.monotonic_ns(), conn_id, direction, len(frame))
+            self.payloads += frame
+            self.count += 1
+            if len(self.payloads) >= self.block_bytes:
+                self.wakeup.set()
+
+    def take_block(self):
+        """Swap out buffered records, return encoded block or None"""
+        with self.lock:
+            if not self.count:
+                return None
+            headers, payloads, count = self.headers, self.payloads, self.count
+            self.headers = bytearray()
+            self.payloads = bytearray()
+            self.count = 0
+        self.recorded += count
+        return BLOCK_HEADER.pack(BLOCK_MAGIC, count, len(payloads)), headers, payloads
+
+    def flusher(self):
+        """Write a block whenever the buffer fills or flush_interval passes"""
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.write_block()
+
+    def write_block(self):
+        block = self.take_block()
+        if block is not None:
+            self.file.writelines(block)
+            self.file.flush()
+
+    def close(self):
+        """Write remaining records and close file"""
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.write_block()
+        self.file.close()
+
+
+def iter_blocks(buffer):
+    """Yield (record_count, headers_offset, payloads_offset) for each complete block in capture buffer"""
+    if len(buffer) < FILE_HEADER.size or buffer[:8] != CAPTURE_MAGIC:
+        raise ValueError("Not a Modbus capture file")
+
+    pos = FILE_HEADER.size
+    end = len(buffer)
+    while pos + BLOCK_HEADER.size <= end:
+        magic, count, payload_size = BLOCK_HEADER.unpack_from(buffer, pos)
+        if magic != BLOCK_MAGIC:
+            raise ValueError(f"Corrupt capture block at offset {pos}")
+        headers_offset = pos + BLOCK_HEADER.size
+        payloads_offset = headers_offset + count * RECORD_HEADER.size
+        if payloads_offset + payload_size > end:
+            break  # block cut short, e.g. capture still being written
+        yield count, headers_offset, payloads_offset
+        pos = payloads_offset + payload_size
+
+
+def capture_start(buffer):
+    """Return (wall_ns, monotonic_ns) recorded when capture was opened"""
+    _, wall_ns, monotonic_ns = FILE_HEADER.unpack_from(buffer)
+    return wall_ns, monotonic_ns
+
+
+def read_capture(path):
+    """Yield (monotonic_ns, conn_id, direction, frame) for every record, reading file through mmap"""
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for count, headers_offset, payload_pos in iter_blocks(buffer):
+                for header in RECORD_HEADER.iter_unpack(buffer[headers_offset:payload_pos]):
+                    timestamp, conn_id, direction, length = header
+                    yield timestamp, conn_id, direction, buffer[payload_pos:payload_pos + length]
+                    payload_pos += length
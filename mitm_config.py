@@ -0,0 +1,72 @@
+import configparser
+
+
+def parse_port_range(text):
+    """Parse '25002-25009' (inclusive) or a single port into a range"""
+    first, _, last = text.partition('-')
+    first = int(first, 0)
+    last = int(last, 0) if last else first
+    if not 0 < first <= last <= 65535:
+        raise ValueError(f"invalid port range {text!r}")
+    return range(first, last + 1)
+
+
+def parse_bool(text):
+    """Parse yes/no, true/false, on/off or 1/0"""
+    value = text.lower()
+    if value in ('yes', 'true', 'on', '1'):
+        return True
+    if value in ('no', 'false', 'off', '0'):
+        return False
+    raise ValueError(f"expected yes or no, got {text!r}")
+
+
+# [proxy] keys and how to convert them
+PROXY_KEYS = {
+    'listen_host': str,
+    'listen_port': lambda text: int(text, 0),
+    'upstream_host': str,
+    'upstream_port': lambda text: int(text, 0),
+    'workers': lambda text: int(text, 0),
+    'source_ports': parse_port_range,
+    'connect_timeout': float,
+    'read_timeout': float,
+    'idle_timeout': float,
+    'tcp_nodelay': parse_bool,
+    'tcp_quickack': parse_bool,
+    'send_buffer': lambda text: int(text, 0),
+    'recv_buffer': lambda text: int(text, 0),
+}
+
+
+def load_config(path):
+    """Read [proxy] settings and [overrides] table from INI file, returning only what the file sets"""
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    try:
+        with open(path) as f:
+            parser.read_file(f)
+    except (OSError, configparser.Error) as e:
+        raise ValueError(f"Cannot read config {path}: {e}")
+
+    config = {}
+    if parser.has_section('proxy'):
+        for key, text in parser.items('proxy'):
+            if key not in PROXY_KEYS:
+                raise ValueError(f"Unknown setting [proxy] {key} in {path}")
+            try:
+                config[key] = PROXY_KEYS[key](text.strip())
+            except ValueError as e:
+                raise ValueError(f"Bad value for [proxy] {key} in {path}: {e}")
+
+    if parser.has_section('overrides'):
+        overrides = {}
+        for address, value in parser.items('overrides'):
+            try:
+                overrides[int(address, 0)] = int(value, 0)
+            except ValueError:
+                raise ValueError(f"Bad override {address} = {value} in {path}")
+        config['overrides'] = overrides
+
+    if config.get('workers', 1) < 1:
+        raise ValueError(f"workers must be at least 1 in {path}")
+    return config
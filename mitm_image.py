@@ -0,0 +1,187 @@
+import json
+import struct
+import sys
+import time
+from array import array
+from urllib.parse import parse_qs
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS  # addresses per page, pages are allocated on first observation
+MAX_QUERY_COUNT = 2000  # addresses per /image query
+
+UINT16_PAIR = struct.Struct('>HH')
+
+# Function code of an upstream response -> table it reports on
+TABLES = {
+    0x01: 'coils',
+    0x02: 'discrete_inputs',
+    0x03: 'holding_registers',
+    0x04: 'input_registers',
+    0x05: 'coils',
+    0x06: 'holding_registers',
+}
+BIT_TABLES = ('coils', 'discrete_inputs')
+TABLE_NAMES = ('coils', 'discrete_inputs', 'holding_registers', 'input_registers')
+
+
+class ImagePage:
+    """Values and wall-clock observation times for PAGE_SIZE consecutive addresses"""
+
+    __slots__ = ('values', 'updated')
+
+    def __init__(self, typecode):
+        self.values = array(typecode, bytes(PAGE_SIZE * array(typecode).itemsize))
+        self.updated = array('d', bytes(PAGE_SIZE * 8))  # 0.0 = never observed
+
+
+class ProcessImage:
+    """Last value and time the upstream device reported for every unit, table and address seen.
+
+    Fed from upstream responses before any rewriting, so it holds what the device returned.
+    Readers only get copies: render_query() and render_snapshot() return JSON text.
+    """
+
+    def __init__(self):
+        self.tables = {}  # {(unit, table): {page number: ImagePage}}
+        self.updates = 0
+
+    def store(self, unit, table, address, values, timestamp):
+        """Write array of values starting at address, spilling over page boundaries"""
+        pages = self.tables.get((unit, table))
+        if pages is None:
+            pages = self.tables[unit, table] = {}
+        typecode = 'B' if table in BIT_TABLES else 'H'
+
+        count = min(len(values), 0x10000 - address)
+        done = 0
+        while done < count:
+            current = address + done
+            number, index = current >> PAGE_BITS, current & (PAGE_SIZE - 1)
+            size = min(PAGE_SIZE - index, count - done)
+            page = pages.get(number)
+            if page is None:
+                page = pages[number] = ImagePage(typecode)
+            page.values[index:index + size] = values[done:done + size]
+            page.updated[index:index + size] = array('d', (timestamp,)) * size
+            done += size
+        self.updates += 1
+
+    def observe_response(self, frame, start, end, read_range, timestamp):
+        """Update from upstream response frame[start:end], read_range is (address, quantity) of its read request"""
+        function_code = frame[start + 7]
+        table = TABLES.get(function_code)
+        if table is None:
+            return
+
+        if function_code <= 0x04:
+            if read_range is None or end - start < 9:
+                return
+            address, quantity = read_range
+            byte_count = frame[start + 8]
+            data = frame[start + 9:start + 9 + byte_count]
+            if len(data) != byte_count:
+                return
+            if function_code >= 0x03:
+                if byte_count != quantity * 2:
+                    return
+                values = array('H', data)
+                if sys.byteorder == 'little':
+                    values.byteswap()
+            else:
+                if byte_count != (quantity + 7) // 8:
+                    return
+                values = array('B', [(data[i >> 3] >> (i & 7)) & 1 for i in range(quantity)])
+
+        # WRITE SINGLE COIL/REGISTER (05, 06): echo confirms the value now in the device
+        else:
+            if end - start < 12:
+                return
+            address, value = UINT16_PAIR.unpack_from(frame, start + 8)
+            if function_code == 0x05:
+                values = array('B', (1 if value == 0xFF00 else 0,))
+            else:
+                values = array('H', (value,))
+
+        self.store(frame[start + 6], table, address, values, timestamp)
+
+    def read(self, unit, table, address, count):
+        """Return (values, updated) lists for count addresses, None where nothing was observed"""
+        pages = self.tables.get((unit, table), {})
+        values, updated = [], []
+        for current in range(address, min(address + count, 0x10000)):
+            page = pages.get(current >> PAGE_BITS)
+            index = current & (PAGE_SIZE - 1)
+            if page is None or not page.updated[index]:
+                values.append(None)
+                updated.append(None)
+            else:
+                values.append(page.values[index])
+                updated.append(round(page.updated[index], 3))
+        return values, updated
+
+    def runs(self, unit, table):
+        """Yield [address, values, updated] for each run of consecutive observed addresses"""
+        pages = self.tables.get((unit, table), {})
+        run = None
+        for number in sorted(pages):
+            page = pages[number]
+            base = number << PAGE_BITS
+            for index, updated in enumerate(page.updated):
+                if not updated:
+                    continue
+                address = base + index
+                if run is None or run[0] + len(run[1]) != address:
+                    if run is not None:
+                        yield run
+                    run = [address, [], []]
+                run[1].append(page.values[index])
+                run[2].append(round(updated, 3))
+        if run is not None:
+            yield run
+
+    def summary(self):
+        """Observed address count, range and latest update per unit and table"""
+        tables = []
+        for unit, table in sorted(self.tables):
+            observed, first, last, latest = 0, None, None, 0.0
+            for address, values, updated in self.runs(unit, table):
+                observed += len(values)
+                if first is None:
+                    first = address
+                last = address + len(values) - 1
+                latest = max(latest, max(updated))
+            tables.append({'unit': unit, 'table': table, 'observed': observed,
+                           'first': first, 'last': last, 'updated': latest})
+        return tables
+
+    def render_query(self, query):
+        """JSON for /image?unit=U&table=T&address=A&count=N, or a summary of all tables without unit"""
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        now = round(time.time(), 3)
+        if 'unit' not in params:
+            return json.dumps({'now': now, 'updates': self.updates, 'tables': self.summary()}) + "\n"
+
+        table = params.get('table', 'holding_registers')
+        if table not in TABLE_NAMES:
+            raise ValueError(f"table must be one of {', '.join(TABLE_NAMES)}")
+        try:
+            unit = int(params['unit'], 0)
+            address = int(params.get('address', '0'), 0)
+            count = int(params.get('count', '1'), 0)
+        except ValueError:
+            raise ValueError("unit, address and count must be integers")
+        if not 0 <= unit <= 255 or not 0 <= address <= 0xFFFF or not 0 < count <= MAX_QUERY_COUNT:
+            raise ValueError(f"need 0 <= unit <= 255, 0 <= address <= 65535, 0 < count <= {MAX_QUERY_COUNT}")
+
+        values, updated = self.read(unit, table, address, count)
+        return json.dumps({'now': now, 'unit': unit, 'table': table, 'address': address,
+                           'values': values, 'updated': updated}) + "\n"
+
+    def render_snapshot(self):
+        """JSON export of every observed value, grouped in runs of consecutive addresses"""
+        tables = []
+        for unit, table in sorted(self.tables):
+            runs = [{'address': address, 'values': values, 'updated': updated}
+                    for address, values, updated in self.runs(unit, table)]
+            tables.append({'unit': unit, 'table': table, 'runs': runs})
+        return json.dumps({'generated': round(time.time(), 3), 'updates': self.updates, 'tables': tables}) + "\n"
@@ -0,0 +1,165 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+LEVELS = {name.lower(): level for level, name in LEVEL_NAMES.items()}
+
+
+class ProxyLogger:
+    """Leveled logger that never blocks the caller: records are queued and written in batches by a thread"""
+
+    def __init__(self, level=DEBUG, stream=None, json_lines=False, sample=None,
+                 queue_size=10000, batch_size=512, flush_interval=0.2):
+        self.level = level
+        self.stream = stream
+        self.json_lines = json_lines
+        self.sample = dict(sample or {})  # {function_code: log 1 of every N frames}
+        self.sample_counts = {}
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.thread = None
+        self.last_second = None
+        self.last_clock = ""
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def configure(self, level=None, stream=None, json_lines=None, sample=None):
+        """Change output settings, safe to call before or after the first record"""
+        if level is not None:
+            self.level = level
+        if stream is not None:
+            self.stream = stream
+        if json_lines is not None:
+            self.json_lines = json_lines
+        if sample is not None:
+            self.sample = dict(sample)
+            self.sample_counts = {}
+
+    def enabled(self, level):
+        """Check level before building expensive messages"""
+        return level >= self.level
+
+    def log(self, level, tag, message, *args, function_code=None):
+        """Queue record, message is %-formatted with args by the writer thread"""
+        if level < self.level:
+            return
+
+        if function_code is not None and function_code in self.sample:
+            count = self.sample_counts.get(function_code, 0)
+            self.sample_counts[function_code] = count + 1
+            if count % self.sample[function_code]:
+                return
+
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((time.time(), level, tag, message, args, function_code))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, tag, message, *args, function_code=None):
+        self.log(DEBUG, tag, message, *args, function_code=function_code)
+
+    def info(self, tag, message, *args, function_code=None):
+        self.log(INFO, tag, message, *args, function_code=function_code)
+
+    def warning(self, tag, message, *args, function_code=None):
+        self.log(WARNING, tag, message, *args, function_code=function_code)
+
+    def error(self, tag, message, *args, function_code=None):
+        self.log(ERROR, tag, message, *args, function_code=function_code)
+
+    def start(self):
+        """Start background writer"""
+        self.thread = threading.Thread(target=self.writer, name="proxy-log", daemon=True)
+        self.thread.start()
+
+    def after_fork(self):
+        """Writer thread does not survive fork, start over with an empty queue"""
+        self.thread = None
+        self.queue = queue.Queue(self.queue.maxsize)
+
+    def close(self):
+        """Flush queued records and stop writer"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def clock(self, timestamp):
+        """Return short timestamp string, formatted once per second"""
+        second = int(timestamp)
+        if second != self.last_second:
+            self.last_second = second
+            self.last_clock = time.strftime("%H:%M:%S", time.localtime(second))
+        return self.last_clock
+
+    def format(self, record):
+        timestamp, level, tag, message, args, function_code = record
+        if args:
+            message = message % args
+
+        if self.json_lines:
+            entry = {
+                'ts': timestamp,
+                'level': LEVEL_NAMES.get(level, str(level)),
+                'tag': tag,
+                'msg': message,
+            }
+            if function_code is not None:
+                entry['fc'] = function_code
+            return json.dumps(entry) + "\n"
+
+        if tag is None:
+            return f"[{self.clock(timestamp)}] {message}\n"
+        return f"[{self.clock(timestamp)}] [{tag}] {message}\n"
+
+    def writer(self):
+        """Drain queue in batches and write each batch with a single call"""
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except (TypeError, ValueError) as e:
+                    lines.append(f"[{self.clock(record[0])}] [LOG] Bad record {record[3]!r}: {e}\n")
+
+            dropped = self.dropped
+            if dropped != self.reported_dropped:
+                lines.append(f"[{self.clock(time.time())}] [LOG] Queue full, dropped "
+                             f"{dropped - self.reported_dropped} records\n")
+                self.reported_dropped = dropped
+
+            if lines:
+                stream = self.stream or sys.stdout
+                try:
+                    stream.write("".join(lines))
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
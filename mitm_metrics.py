@@ -0,0 +1,266 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+
+HISTOGRAM_MIN_BITS = 10  # first bucket: below 2**10 ns (~1us)
+HISTOGRAM_BUCKETS = 27  # last finite bucket: below 2**36 ns (~69s)
+
+
+def function_label(function_code):
+    return f"0x{function_code:02X}"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Histogram:
+    """Log-bucketed duration histogram in nanoseconds, bucket i counts values below 2**(10+i) ns"""
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (HISTOGRAM_BUCKETS + 1)  # last bucket is +Inf
+        self.count = 0
+        self.total = 0
+
+    def observe(self, nanoseconds):
+        index = nanoseconds.bit_length() - HISTOGRAM_MIN_BITS
+        if index < 0:
+            index = 0
+        elif index > HISTOGRAM_BUCKETS:
+            index = HISTOGRAM_BUCKETS
+        self.counts[index] += 1
+        self.count += 1
+        self.total += nanoseconds
+
+    def quantile(self, fraction):
+        """Return upper bound in ns of the bucket holding the given quantile"""
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return 1 << (HISTOGRAM_MIN_BITS + index)
+        return 1 << (HISTOGRAM_MIN_BITS + HISTOGRAM_BUCKETS)
+
+    def fraction_below(self, nanoseconds):
+        """Return share of observations in buckets entirely below nanoseconds"""
+        if not self.count:
+            return 1.0
+        below = 0
+        for index, bucket_count in enumerate(self.counts[:HISTOGRAM_BUCKETS]):
+            if 1 << (HISTOGRAM_MIN_BITS + index) > nanoseconds:
+                break
+            below += bucket_count
+        return below / self.count
+
+    def render(self, name, labels=None):
+        """Return Prometheus text lines for histogram in seconds"""
+        labels = dict(labels or {})
+        lines = []
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if index < HISTOGRAM_BUCKETS:
+                labels['le'] = f"{(1 << (HISTOGRAM_MIN_BITS + index)) / 1e9:.9g}"
+            else:
+                labels['le'] = "+Inf"
+            lines.append(f"{name}_bucket{format_labels(labels)} {cumulative}")
+        del labels['le']
+        lines.append(f"{name}_sum{format_labels(labels)} {self.total / 1e9:.9f}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class ConnectionStats:
+    """Counters for one proxied connection"""
+
+    __slots__ = ('client_addr', 'requests', 'responses', 'request_bytes', 'response_bytes',
+                 'errors', 'rewrites')
+
+    def __init__(self, client_addr):
+        self.client_addr = client_addr
+        self.requests = 0
+        self.responses = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.errors = 0
+        self.rewrites = 0
+
+
+class ProxyMetrics:
+    """Frame, byte, error and rewrite counters per function code and connection, plus upstream RTT"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.frames = defaultdict(int)  # {(direction, function_code): count}
+        self.bytes = defaultdict(int)  # {(direction, function_code): bytes}
+        self.errors = defaultdict(int)  # {(kind, function_code or None): count}
+        self.rewrites = defaultdict(int)  # {(kind, function_code): count}
+        self.upstream_rtt = defaultdict(Histogram)  # {function_code: Histogram}
+        self.spliced_bytes = defaultdict(int)  # {direction: bytes} forwarded without inspection
+        self.stages = defaultdict(Histogram)  # {(stage, function_code): Histogram} with --stage-timing
+        self.connections = {}  # {conn_id: ConnectionStats} for open connections
+        self.connections_total = 0
+
+    def open_connection(self, conn_id, client_addr):
+        self.connections_total += 1
+        stats = self.connections[conn_id] = ConnectionStats(client_addr)
+        return stats
+
+    def close_connection(self, conn_id):
+        self.connections.pop(conn_id, None)
+
+    def request(self, stats, function_code, size):
+        key = ('request', function_code)
+        self.frames[key] += 1
+        self.bytes[key] += size
+        stats.requests += 1
+        stats.request_bytes += size
+
+    def response(self, stats, function_code, size, rtt_ns=None):
+        key = ('response', function_code)
+        self.frames[key] += 1
+        self.bytes[key] += size
+        stats.responses += 1
+        stats.response_bytes += size
+        if rtt_ns is not None:
+            self.upstream_rtt[function_code & 0x7F].observe(rtt_ns)
+
+    def spliced(self, stats, direction, size):
+        self.spliced_bytes[direction] += size
+        if direction == 'request':
+            stats.request_bytes += size
+        else:
+            stats.response_bytes += size
+
+    def stage(self, name, function_code, nanoseconds):
+        self.stages[(name, function_code)].observe(nanoseconds)
+
+    def stage_shared(self, name, function_codes, nanoseconds):
+        """Split a stage that handled several frames at once evenly between them"""
+        if function_codes:
+            share = nanoseconds // len(function_codes)
+            for function_code in function_codes:
+                self.stages[(name, function_code)].observe(share)
+
+    def error(self, kind, function_code=None, stats=None):
+        self.errors[(kind, function_code)] += 1
+        if stats is not None:
+            stats.errors += 1
+
+    def rewrite(self, kind, function_code, stats=None):
+        self.rewrites[(kind, function_code)] += 1
+        if stats is not None:
+            stats.rewrites += 1
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format"""
+        lines = [
+            "# TYPE modbus_mitm_uptime_seconds gauge",
+            f"modbus_mitm_uptime_seconds {time.time() - self.started:.3f}",
+            "# TYPE modbus_mitm_connections_active gauge",
+            f"modbus_mitm_connections_active {len(self.connections)}",
+            "# TYPE modbus_mitm_connections_total counter",
+            f"modbus_mitm_connections_total {self.connections_total}",
+        ]
+
+        for name, table in (('frames', self.frames), ('bytes', self.bytes)):
+            lines.append(f"# TYPE modbus_mitm_{name}_total counter")
+            for (direction, function_code), value in sorted(table.items()):
+                labels = {'direction': direction, 'function': function_label(function_code)}
+                lines.append(f"modbus_mitm_{name}_total{format_labels(labels)} {value}")
+
+        lines.append("# TYPE modbus_mitm_spliced_bytes_total counter")
+        for direction, value in sorted(self.spliced_bytes.items()):
+            lines.append(f"modbus_mitm_spliced_bytes_total{format_labels({'direction': direction})} {value}")
+
+        lines.append("# TYPE modbus_mitm_errors_total counter")
+        for (kind, function_code), value in sorted(self.errors.items(), key=lambda item: str(item[0])):
+            labels = {'kind': kind}
+            if function_code is not None:
+                labels['function'] = function_label(function_code)
+            lines.append(f"modbus_mitm_errors_total{format_labels(labels)} {value}")
+
+        lines.append("# TYPE modbus_mitm_rewrites_total counter")
+        for (kind, function_code), value in sorted(self.rewrites.items()):
+            labels = {'kind': kind, 'function': function_label(function_code)}
+            lines.append(f"modbus_mitm_rewrites_total{format_labels(labels)} {value}")
+
+        lines.append("# TYPE modbus_mitm_upstream_rtt_seconds histogram")
+        for function_code, histogram in sorted(self.upstream_rtt.items()):
+            lines.extend(histogram.render('modbus_mitm_upstream_rtt_seconds',
+                                          {'function': function_label(function_code)}))
+
+        lines.append("# TYPE modbus_mitm_stage_seconds histogram")
+        for (stage, function_code), histogram in sorted(self.stages.items()):
+            lines.extend(histogram.render('modbus_mitm_stage_seconds',
+                                          {'stage': stage, 'function': function_label(function_code)}))
+
+        for field in ('requests', 'responses', 'request_bytes', 'response_bytes', 'errors', 'rewrites'):
+            lines.append(f"# TYPE modbus_mitm_connection_{field}_total counter")
+            for conn_id, stats in sorted(self.connections.items()):
+                labels = {'conn': conn_id, 'client': stats.client_addr}
+                lines.append(f"modbus_mitm_connection_{field}_total{format_labels(labels)} "
+                             f"{getattr(stats, field)}")
+
+        return "\n".join(lines) + "\n"
+
+
+async def handle_http(reader, writer, routes):
+    """Answer one GET request from routes {path: callable(query) -> (content_type, body)}"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass  # skip headers
+
+        parts = request_line.decode('latin-1').split()
+        status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        if len(parts) >= 2 and parts[0] == 'GET':
+            path, _, query = parts[1].partition('?')
+            handler = routes.get(path)
+            if handler:
+                try:
+                    content_type, body = handler(query)
+                    status = "200 OK"
+                except ValueError as e:
+                    status, body = "400 Bad Request", f"{e}\n"
+        elif parts:
+            status, body = "405 Method Not Allowed", "only GET is supported\n"
+
+        payload = body.encode()
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_http(host, port, routes, reuse_port=False):
+    """Start local read-only HTTP endpoint on the running loop, reuse_port lets a successor bind while it runs"""
+    return await asyncio.start_server(lambda r, w: handle_http(r, w, routes), host, port, reuse_address=True,
+                                      reuse_port=reuse_port)
+
+
+def write_text_file(path, text):
+    """Replace file atomically so readers never see a partial write"""
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+async def write_stats_periodically(path, interval, render):
+    """Rewrite stats file with render() every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        text = render()
+        await asyncio.get_running_loop().run_in_executor(None, write_text_file, path, text)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of the per-frame functions of modbus_mitm, without sockets or an event loop.
+
+    python mitm_microbench.py                              # all cases, ns and allocations per frame
+    python mitm_microbench.py --save baseline.json         # store results as the baseline
+    python mitm_microbench.py --baseline baseline.json     # compare, exit status 1 on regression
+    python mitm_microbench.py --filter restore
+
+Time per frame is the best of --repeat runs of --number calls, minus the bare loop. Allocations per frame
+count memory blocks (and bytes) still held per call while every result is kept, i.e. what a call creates
+and hands back. Peak bytes per frame is the most memory a single call had allocated at once, results and
+temporaries together, which is where per-frame churn shows. Baselines are only comparable on the machine
+and Python version that wrote them.
+"""
+import argparse
+import gc
+import itertools
+import json
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+
+import modbus_mitm
+from mitm_log import LEVELS
+from modbus_mitm import (MBAP_HEADER, UINT16_PAIR, build_modbus_response, parse_modbus_request,
+                         parse_modbus_response, restore_read_response)
+
+QUANTITIES = (1, 8, 32, 64, 125)  # registers (or coils) per frame, clamped to each function's limit
+OVERRIDE_ADDRESS = 0x0002
+CLIENT = ('192.0.2.1', 50000)
+
+
+def mbap(function_code, pdu, transaction_id=1, unit_id=1):
+    return MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 2, unit_id, function_code) + pdu
+
+
+def registers(count, first=0x1234):
+    return struct.pack(f'>{count}H', *((first + i) & 0xFFFF for i in range(count)))
+
+
+def request_frames():
+    """Yield (name, frame) for every request shape the proxy decodes"""
+    for function_code in (0x01, 0x02, 0x03, 0x04):
+        limit = 2000 if function_code <= 0x02 else 125
+        for quantity in sorted({min(q, limit) for q in QUANTITIES}):
+            yield f'{function_code:02X} x{quantity}', mbap(function_code, UINT16_PAIR.pack(0x0100, quantity))
+    yield '05', mbap(0x05, UINT16_PAIR.pack(0x0100, 0xFF00))
+    yield '06', mbap(0x06, UINT16_PAIR.pack(0x0100, 0x1234))
+    for quantity in sorted({min(q, 1968) for q in QUANTITIES}):
+        data = bytes((quantity + 7) // 8)
+        yield f'0F x{quantity}', mbap(0x0F, struct.pack('>HHB', 0x0100, quantity, len(data)) + data)
+    for quantity in sorted({min(q, 123) for q in QUANTITIES}):
+        yield f'10 x{quantity}', mbap(0x10, struct.pack('>HHB', 0x0100, quantity, quantity * 2) + registers(quantity))
+    yield '16', mbap(0x16, struct.pack('>HHH', 0x0100, 0xF0F0, 0x0F0F))
+    for quantity in sorted({min(q, 121) for q in QUANTITIES}):
+        yield f'17 x{quantity}', mbap(0x17, struct.pack('>HHHHB', 0x0100, quantity, 0x0200, quantity, quantity * 2)
+                                      + registers(quantity))
+
+
+def response_frames():
+    """Yield (name, frame) for every response shape the proxy decodes"""
+    for function_code in (0x01, 0x02):
+        for quantity in sorted({min(q, 2000) for q in QUANTITIES}):
+            data = bytes((quantity + 7) // 8)
+            yield f'{function_code:02X} x{quantity}', mbap(function_code, bytes((len(data),)) + data)
+    for function_code in (0x03, 0x04, 0x17):
+        for quantity in QUANTITIES:
+            yield f'{function_code:02X} x{quantity}', mbap(function_code, bytes((quantity * 2,)) + registers(quantity))
+    for function_code in (0x05, 0x06, 0x0F, 0x10):
+        yield f'{function_code:02X}', mbap(function_code, UINT16_PAIR.pack(0x0100, 0x0010))
+    yield '16', mbap(0x16, struct.pack('>HHH', 0x0100, 0xF0F0, 0x0F0F))
+    yield '83 exception', mbap(0x83, b'\x02')
+
+
+def read_response(request, first=0x1234):
+    quantity = request.quantity
+    return mbap(0x03, bytes((quantity * 2,)) + registers(quantity, first), request.transaction_id)
+
+
+def cases():
+    """Yield (name, function, args) for every benchmark case"""
+    for name, frame in request_frames():
+        yield f'parse {name}', parse_modbus_request, (frame,)
+    for name, frame in response_frames():
+        yield f'parse response {name}', parse_modbus_response, (frame,)
+
+    write = parse_modbus_request(mbap(0x06, UINT16_PAIR.pack(OVERRIDE_ADDRESS, 0x1234)))
+    yield 'build 06', build_modbus_response, (write, 0x1000, 0x1234)
+    yield 'build 06 echo', build_modbus_response, (write, 0x1234)
+    read = parse_modbus_request(mbap(0x03, UINT16_PAIR.pack(OVERRIDE_ADDRESS, 1)))
+    yield 'build 03', build_modbus_response, (read, 0x1234)
+
+    # miss: no override inside the read range, hit: one overridden register restored to the client's value
+    for quantity in QUANTITIES:
+        miss = parse_modbus_request(mbap(0x03, UINT16_PAIR.pack(0x0100, quantity)))
+        yield f'restore 03 x{quantity} miss', restore_read_response, (read_response(miss), miss, CLIENT)
+        hit = parse_modbus_request(mbap(0x03, UINT16_PAIR.pack(OVERRIDE_ADDRESS, quantity)))
+        yield f'restore 03 x{quantity} hit', restore_read_response, (read_response(hit), hit, CLIENT)
+    other = parse_modbus_request(mbap(0x04, UINT16_PAIR.pack(OVERRIDE_ADDRESS, 8)))
+    yield 'restore 04 x8', restore_read_response, (read_response(other), other, CLIENT)
+
+
+def loop_overhead(number):
+    started = time.perf_counter_ns()
+    for _ in itertools.repeat(None, number):
+        pass
+    return time.perf_counter_ns() - started
+
+
+def time_per_call(function, args, number, repeat):
+    """Best ns per call over repeat runs of number calls, bare loop cost subtracted"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for _ in itertools.repeat(None, number):
+            function(*args)
+        elapsed = time.perf_counter_ns() - started - loop_overhead(number)
+        if best is None or elapsed < best:
+            best = elapsed
+    return max(best, 0) / number
+
+
+def allocations_per_call(function, args, number):
+    """Return (blocks, bytes) per call still allocated while all results are kept, and mean peak bytes per call"""
+    results = [None] * number
+    function(*args)  # warm caches so one-time allocations are not charged to the calls
+    blocks_before = sys.getallocatedblocks()
+    for i in range(number):
+        results[i] = function(*args)
+    blocks = sys.getallocatedblocks() - blocks_before
+    results = [None] * number
+
+    tracemalloc.start()
+    try:
+        bytes_before = tracemalloc.get_traced_memory()[0]
+        for i in range(number):
+            results[i] = function(*args)
+        size = tracemalloc.get_traced_memory()[0] - bytes_before
+        results = None
+
+        peak = 0
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            result = function(*args)
+            peak += tracemalloc.get_traced_memory()[1] - current
+            result = None
+    finally:
+        tracemalloc.stop()
+    return max(blocks, 0) / number, max(size, 0) / number, peak / number
+
+
+def run(selected, number, repeat):
+    """Benchmark selected cases, return {name: {'ns': ..., 'allocs': ..., 'bytes': ..., 'peak': ...}}"""
+    modbus_mitm.overrides.clear()
+    modbus_mitm.overrides[OVERRIDE_ADDRESS] = 0x1000
+    modbus_mitm.client_original_values[CLIENT][OVERRIDE_ADDRESS] = 0x1234
+
+    results = {}
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for name, function, args in selected:
+            ns = time_per_call(function, args, number, repeat)
+            allocs, size, peak = allocations_per_call(function, args, min(number, 1000))
+            results[name] = {'ns': round(ns, 1), 'allocs': round(allocs, 2), 'bytes': round(size, 1),
+                             'peak': round(peak, 1)}
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return {name: reasons} for cases slower than baseline by more than tolerance or allocating more"""
+    regressions = {}
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        reasons = []
+        if result['ns'] > before['ns'] * (1 + tolerance):
+            reasons.append(f"time {before['ns']:.0f} -> {result['ns']:.0f}ns")
+        if result['allocs'] > before['allocs'] + 0.05:
+            reasons.append(f"allocs {before['allocs']:g} -> {result['allocs']:g}")
+        if result['peak'] > before['peak'] + 8:
+            reasons.append(f"peak {before['peak']:g} -> {result['peak']:g} bytes")
+        if reasons:
+            regressions[name] = reasons
+    return regressions
+
+
+def print_report(results, baseline, regressions):
+    print(f"{'case':<30} {'ns/frame':>9} {'allocs':>7} {'bytes':>7} {'peak':>7} {'baseline':>9} {'change':>8}")
+    for name, r in results.items():
+        before = baseline.get(name)
+        if before:
+            change = (r['ns'] / before['ns'] - 1) * 100 if before['ns'] else 0.0
+            compared = f"{before['ns']:>9.1f} {change:>+7.1f}%"
+        else:
+            compared = f"{'-':>9} {'-':>8}"
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<30} {r['ns']:>9.1f} {r['allocs']:>7.2f} {r['bytes']:>7.1f} {r['peak']:>7.1f} {compared}{flag}")
+
+    if regressions:
+        print()
+    for name, reasons in regressions.items():
+        print(f"[!] {name}: {', '.join(reasons)}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Micro-benchmark the per-frame functions of modbus_mitm")
+    parser.add_argument('--number', type=int, default=20000, help="calls per timing run")
+    parser.add_argument('--repeat', type=int, default=5, help="timing runs per case, the best one counts")
+    parser.add_argument('--filter', action='append', default=[], metavar='TEXT',
+                        help="only cases whose name contains TEXT (repeatable)")
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get), default='warning',
+                        help="proxy log level while measuring, debug/info include queuing log records")
+    parser.add_argument('--baseline', metavar='FILE', help="compare against results stored with --save")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="fraction a case may be slower than the baseline before it is flagged")
+    parser.add_argument('--save', metavar='FILE', help="write results as a baseline file")
+    args = parser.parse_args(argv)
+    if args.number < 1 or args.repeat < 1:
+        parser.error("--number and --repeat must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    modbus_mitm.log.configure(level=LEVELS[args.log_level])
+
+    selected = [case for case in cases() if not args.filter or any(text in case[0] for text in args.filter)]
+    if not selected:
+        raise SystemExit("no case matches --filter")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+        if any('peak' not in before for before in baseline.values()):
+            raise SystemExit(f"{args.baseline} has no peak bytes, save a new baseline with --save")
+
+    print(f"Python {platform.python_version()}, {args.number} calls x {args.repeat} runs per case\n")
+    results = run(selected, args.number, args.repeat)
+    regressions = compare(results, baseline, args.tolerance)
+    print_report(results, baseline, regressions)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'cases': results}, f, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""Availability and latency prober for Modbus TCP and HTTP services.
+
+    python mitm_probe.py --modbus 127.0.0.1:502 --http http://localhost:9090/ScadaBR --interval 0.2 --metrics-port 9600
+
+Each target keeps one connection open and is sampled every --interval seconds. Only request/response time
+is recorded as latency; reconnects are counted and timed separately. Results are served and written in the
+proxy's metrics format.
+"""
+import abc
+import argparse
+import asyncio
+import socket
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from mitm_log import LEVELS, ProxyLogger
+from mitm_metrics import Histogram, format_labels, serve_http, write_stats_periodically
+from modbus_mitm import MBAP_HEADER, UINT16_PAIR
+
+log = ProxyLogger()
+
+
+WELL_FORMED = frozenset(('ok', 'exception', 'http_error'))  # complete answers, the connection stays usable
+
+
+class ProbeTarget(abc.ABC):
+    """One kept-open connection to a service plus the results of probing it"""
+
+    kind = None
+
+    def __init__(self, name, host, port, slo_ns):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.slo_ns = slo_ns  # latency thresholds, a sample is good for threshold t if ok and <= t
+        self.reader = self.writer = None
+        self.answered = False
+        self.results = defaultdict(int)  # {result: count}
+        self.good = [0] * len(slo_ns)
+        self.samples = 0
+        self.latency = Histogram()
+        self.connect_latency = Histogram()
+        self.connects = 0
+        self.up = None
+        self.window = (0, 0, [0] * len(slo_ns), 0)  # samples, ok, good, max latency since last report
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    @abc.abstractmethod
+    async def probe(self):
+        """Send one request on the open connection and return result name, 'ok' when healthy"""
+
+    async def open(self, timeout):
+        """Connect and time it, return None or the failure result"""
+        started = time.perf_counter_ns()
+        try:
+            await asyncio.wait_for(self.connect(), timeout)
+        except asyncio.TimeoutError:
+            return 'connect_timeout'
+        except ConnectionRefusedError:
+            return 'refused'
+        except OSError:
+            return 'connect_error'
+        self.connects += 1
+        self.connect_latency.observe(time.perf_counter_ns() - started)
+        return None
+
+    async def attempt(self, timeout):
+        """Probe on the open connection, return (result, elapsed ns)"""
+        self.answered = False  # set by probe() once the first byte of the reply is in
+        started = time.perf_counter_ns()
+        try:
+            result = await asyncio.wait_for(self.probe(), timeout)
+        except asyncio.TimeoutError:
+            result = 'timeout'
+        except (asyncio.IncompleteReadError, ConnectionError):
+            result = 'reset'
+        except (OSError, ValueError):
+            result = 'error'
+        return result, time.perf_counter_ns() - started
+
+    async def sample(self, timeout):
+        """Probe once, connecting first if needed"""
+        reused = self.writer is not None
+        if not reused:
+            failure = await self.open(timeout)
+            if failure:
+                return self.record(failure)
+
+        result, elapsed = await self.attempt(timeout)
+        if result == 'reset' and reused and not self.answered:
+            # The service closed the idle connection before our request arrived, not an outage
+            self.close()
+            failure = await self.open(timeout)
+            if failure:
+                return self.record(failure)
+            result, elapsed = await self.attempt(timeout)
+
+        if result not in WELL_FORMED:
+            self.close()  # a late or garbled reply must not be read as the next answer
+        return self.record(result, elapsed)
+
+    def record(self, result, elapsed=None):
+        self.samples += 1
+        self.results[result] += 1
+        samples, ok, good, worst = self.window
+        samples += 1
+        if result == 'ok':
+            ok += 1
+            worst = max(worst, elapsed)
+            self.latency.observe(elapsed)
+            for i, threshold in enumerate(self.slo_ns):
+                if elapsed <= threshold:
+                    self.good[i] += 1
+                    good[i] += 1
+        self.window = (samples, ok, good, worst)
+
+        if elapsed is not None:
+            log.debug(self.kind.upper(), "%s: %s in %.2fms", self.name, result, elapsed / 1e6)
+        else:
+            log.debug(self.kind.upper(), "%s: %s", self.name, result)
+        up = result == 'ok'
+        if up != self.up:
+            if up:
+                log.info('+', "%s is up", self.name)
+            else:
+                log.warning('!', "%s is down: %s", self.name, result.replace('_', ' '))
+            self.up = up
+        return result
+
+    def report(self):
+        """Log results since the previous report"""
+        samples, ok, good, worst = self.window
+        self.window = (0, 0, [0] * len(self.slo_ns), 0)
+        if not samples:
+            return
+        within = ", ".join(f"{good[i] / samples:.1%} <= {threshold / 1e6:g}ms"
+                           for i, threshold in enumerate(self.slo_ns))
+        if ok:
+            log.info(None, "%s: %d/%d ok, max %.2fms, %s", self.name, ok, samples, worst / 1e6, within)
+        else:
+            log.info(None, "%s: 0/%d ok", self.name, samples)
+
+
+class ModbusTarget(ProbeTarget):
+    """READ HOLDING REGISTERS (03) probe, answer must match transaction id and register count"""
+
+    kind = 'modbus'
+
+    def __init__(self, name, host, port, slo_ns, unit=1, address=5, count=5):
+        super().__init__(name, host, port, slo_ns)
+        self.unit = unit
+        self.address = address
+        self.count = count
+        self.transaction_id = 0
+
+    async def probe(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        self.writer.write(MBAP_HEADER.pack(self.transaction_id, 0, 6, self.unit, 0x03)
+                          + UINT16_PAIR.pack(self.address, self.count))
+        await self.writer.drain()
+
+        header = await self.reader.readexactly(MBAP_HEADER.size)
+        self.answered = True
+        transaction_id, _, length, _, function_code = MBAP_HEADER.unpack(header)
+        if not 2 <= length <= 254:
+            return 'bad_response'
+        body = await self.reader.readexactly(length - 2)
+        if transaction_id != self.transaction_id:
+            return 'bad_response'
+        if function_code == 0x83:
+            return 'exception'
+        if function_code != 0x03 or not body or body[0] != self.count * 2:
+            return 'bad_response'
+        return 'ok'
+
+
+NO_BODY_STATUSES = frozenset((204, 304))  # never carry a body, whatever the headers say (1xx neither)
+
+
+class HttpTarget(ProbeTarget):
+    """HTTP/1.1 GET probe on a keep-alive connection, any status below 400 is healthy"""
+
+    kind = 'http'
+
+    def __init__(self, name, url, slo_ns):
+        parts = urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise ValueError(f"only http:// URLs are supported: {url}")
+        super().__init__(name, parts.hostname, parts.port or 80, slo_ns)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        self.request = (f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: mitm_probe\r\n"
+                        f"Connection: keep-alive\r\n\r\n").encode()
+
+    async def read_head(self):
+        """Return (version, status, {lowercase header: lowercase value}) of the next response, status None if bad"""
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed")
+        self.answered = True
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            return None, None, {}
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise ConnectionResetError("connection closed in headers")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        return parts[0], int(parts[1]), headers
+
+    async def probe(self):
+        self.writer.write(self.request)
+        await self.writer.drain()
+
+        version, status, headers = await self.read_head()
+        while status is not None and 100 <= status < 200:
+            version, status, headers = await self.read_head()  # interim response, the final one follows
+        if status is None:
+            return 'bad_response'
+
+        # Read the whole body so the next request starts on a clean stream
+        if status in NO_BODY_STATUSES:
+            pass
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)  # chunk + CRLF
+                if not size:
+                    break
+        elif 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+            self.close()
+        # HTTP/1.0 servers close after every response unless they offered keep-alive
+        connection = headers.get('connection')
+        if connection == 'close' or (version == b'HTTP/1.0' and connection != 'keep-alive'):
+            self.close()
+
+        return 'ok' if status < 400 else 'http_error'
+
+
+def render_metrics(targets, started):
+    """Prometheus text for all targets, same conventions as the proxy's /metrics"""
+    lines = [
+        "# TYPE mitm_probe_uptime_seconds gauge",
+        f"mitm_probe_uptime_seconds {time.time() - started:.3f}",
+        "# TYPE mitm_probe_up gauge",
+    ]
+    for target in targets:
+        lines.append(f"mitm_probe_up{format_labels({'target': target.name, 'kind': target.kind})} {int(bool(target.up))}")
+
+    lines.append("# TYPE mitm_probe_samples_total counter")
+    for target in targets:
+        for result, count in sorted(target.results.items()):
+            labels = {'target': target.name, 'kind': target.kind, 'result': result}
+            lines.append(f"mitm_probe_samples_total{format_labels(labels)} {count}")
+
+    lines.append("# TYPE mitm_probe_connects_total counter")
+    for target in targets:
+        lines.append(f"mitm_probe_connects_total{format_labels({'target': target.name, 'kind': target.kind})} "
+                     f"{target.connects}")
+
+    for name in ('slo_good_total', 'slo_ratio'):
+        lines.append(f"# TYPE mitm_probe_{name} {'counter' if name.endswith('total') else 'gauge'}")
+        for target in targets:
+            for threshold, good in zip(target.slo_ns, target.good):
+                labels = {'target': target.name, 'kind': target.kind, 'le': f"{threshold / 1e9:.9g}"}
+                value = good if name == 'slo_good_total' else f"{good / target.samples if target.samples else 1:.6f}"
+                lines.append(f"mitm_probe_{name}{format_labels(labels)} {value}")
+
+    for name, attribute in (('latency_seconds', 'latency'), ('connect_seconds', 'connect_latency')):
+        lines.append(f"# TYPE mitm_probe_{name} histogram")
+        for target in targets:
+            lines.extend(getattr(target, attribute).render(f'mitm_probe_{name}',
+                                                           {'target': target.name, 'kind': target.kind}))
+
+    return "\n".join(lines) + "\n"
+
+
+async def run_target(target, interval, timeout):
+    """Sample target on a fixed schedule, skipping slots instead of bursting when a probe overruns"""
+    loop = asyncio.get_running_loop()
+    due = loop.time()
+    while True:
+        await target.sample(timeout)
+        due += interval
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            due = loop.time()
+
+
+async def report_periodically(targets, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for target in targets:
+            target.report()
+
+
+async def run(args, targets):
+    started = time.time()
+    render = lambda: render_metrics(targets, started)
+    tasks = [asyncio.ensure_future(run_target(target, args.interval, args.timeout)) for target in targets]
+    if args.report_interval:
+        tasks.append(asyncio.ensure_future(report_periodically(targets, args.report_interval)))
+    if args.stats_file:
+        tasks.append(asyncio.ensure_future(write_stats_periodically(args.stats_file, args.stats_interval, render)))
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = await serve_http(args.metrics_host, args.metrics_port,
+                                          {'/metrics': lambda query: ("text/plain; version=0.0.4", render())})
+        log.info(None, "Metrics on http://%s:%d/metrics", args.metrics_host, args.metrics_port)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for target in targets:
+            target.close()
+        if metrics_server:
+            metrics_server.close()
+
+
+def parse_host_port(text, default_port):
+    host, _, port = text.rpartition(':')
+    if not host:
+        return text, default_port
+    return host, int(port)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Probe Modbus TCP and HTTP availability and latency")
+    parser.add_argument('--modbus', action='append', default=[], metavar='HOST:PORT',
+                        help="Modbus TCP target (repeatable), default 127.0.0.1:502 when no target is given")
+    parser.add_argument('--http', action='append', default=[], metavar='URL', help="HTTP target (repeatable)")
+    parser.add_argument('--unit', type=int, default=1, help="Modbus unit id")
+    parser.add_argument('--address', type=int, default=5, help="first holding register read")
+    parser.add_argument('--count', type=int, default=5, help="holding registers read per probe")
+    parser.add_argument('--interval', type=float, default=0.2, help="seconds between probes of a target")
+    parser.add_argument('--timeout', type=float, default=1.0, help="seconds to connect or to get an answer")
+    parser.add_argument('--slo', default='10,100', metavar='MS,...',
+                        help="latency thresholds in ms, a probe is good for each threshold it answers within")
+    parser.add_argument('--report-interval', type=float, default=10.0,
+                        help="seconds between summary log lines (0 = only state changes)")
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get), default='info',
+                        help="debug logs every probe")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--metrics-port', type=int, default=0, help="serve Prometheus text metrics (0 = off)")
+    parser.add_argument('--stats-file', help="periodically rewrite FILE with the same metrics text")
+    parser.add_argument('--stats-interval', type=float, default=5.0, help="seconds between --stats-file writes")
+    args = parser.parse_args(argv)
+
+    try:
+        args.slo_ns = sorted(int(float(ms) * 1e6) for ms in args.slo.split(',') if ms)
+    except ValueError:
+        parser.error(f"invalid --slo {args.slo!r}, expected comma separated milliseconds")
+    if args.interval <= 0 or args.timeout <= 0:
+        parser.error("--interval and --timeout must be positive")
+    if not 1 <= args.count <= 125:
+        parser.error("--count must be 1..125")
+    if not args.modbus and not args.http:
+        args.modbus = ['127.0.0.1:502']
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log.configure(level=LEVELS[args.log_level])
+    try:
+        targets = [ModbusTarget(f"modbus://{text}", *parse_host_port(text, 502), args.slo_ns,
+                                args.unit, args.address, args.count) for text in args.modbus]
+        targets += [HttpTarget(url, url, args.slo_ns) for url in args.http]
+    except ValueError as e:
+        sys.exit(f"mitm_probe: {e}")
+
+    log.info(None, "Probing %s every %gs", ", ".join(target.name for target in targets), args.interval)
+    try:
+        asyncio.run(run(args, targets))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+TOP_ENTRIES = 40  # lines in the text summary written next to each dump
+
+active = set()  # kinds of window currently running in this process
+windows = set()  # running window tasks, the event loop itself only keeps weak references
+
+
+def dump_path(directory, kind, extension):
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(directory, f"mitm-{kind}-{os.getpid()}-{stamp}.{extension}")
+
+
+async def profile_cpu(seconds, directory):
+    """cProfile everything the event loop runs for seconds, return paths of .prof dump and text summary"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    path = dump_path(directory, 'cpu', 'prof')
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(TOP_ENTRIES)
+    with open(path[:-len('prof')] + 'txt', 'w') as f:
+        f.write(summary.getvalue())
+    return path
+
+
+async def trace_allocations(seconds, directory, frames=8):
+    """Trace allocations for seconds, return path of the snapshot dump; the text summary lists growth by line"""
+    tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    path = dump_path(directory, 'alloc', 'tracemalloc')
+    after.dump(path)
+    lines = [f"Allocation growth over {seconds:g}s, top {TOP_ENTRIES} lines\n"]
+    lines.extend(f"{stat}\n" for stat in after.compare_to(before, 'lineno')[:TOP_ENTRIES])
+    with open(path[:-len('tracemalloc')] + 'txt', 'w') as f:
+        f.writelines(lines)
+    return path
+
+
+WINDOWS = {'cpu': profile_cpu, 'alloc': trace_allocations}
+
+
+def start_window(kind, seconds, directory, log):
+    """Run a bounded profiling window of kind on the running loop, ignored while one of that kind is running"""
+    if kind in active:
+        log.warning('!', "%s profiling already running, ignoring request", kind)
+        return
+
+    async def window():
+        log.info(None, "Started %s profiling for %gs", kind, seconds)
+        try:
+            path = await WINDOWS[kind](seconds, directory)
+        except (OSError, ValueError) as e:  # ValueError: another profiler already holds the interpreter
+            log.error('!', "%s profiling failed: %s", kind, e)
+        else:
+            log.info(None, "Wrote %s profile to %s", kind, path)
+        finally:
+            active.discard(kind)
+
+    active.add(kind)  # before the task first runs, so a second signal in the same loop turn is ignored too
+    task = asyncio.ensure_future(window())
+    windows.add(task)
+    task.add_done_callback(windows.discard)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Replay client frames from a proxy capture against a Modbus TCP server.
+
+    python mitm_replay.py capture.bin --port 1502 --speed 10
+"""
+import argparse
+import asyncio
+import time
+
+from mitm_capture import DIR_CLIENT, read_capture
+from modbus_mitm import MODBUS_TCP_PORT, MBAPReassembler
+
+
+class ReplayConnection:
+    """One replayed client connection, responses are read and counted in the background"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.sent = 0
+        self.received = 0
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    async def read_responses(self):
+        reassembler = MBAPReassembler()
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                return
+            self.received += len(reassembler.feed(data))
+
+    async def close(self, timeout):
+        """Wait up to timeout for outstanding responses, then close"""
+        deadline = time.monotonic() + timeout
+        while self.received < self.sent and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+async def replay(path, host, port, speed, drain_timeout):
+    """Re-send client frames with recorded spacing divided by speed (0 = as fast as possible)"""
+    connections = {}
+    start = None
+    late = 0
+    max_late = 0.0
+
+    for timestamp, conn_id, direction, frame in read_capture(path):
+        if direction != DIR_CLIENT:
+            continue
+
+        if start is None:
+            start = (timestamp, time.monotonic())
+        if speed:
+            due = start[1] + (timestamp - start[0]) / 1e9 / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -0.001:
+                late += 1
+                max_late = max(max_late, -delay)
+
+        connection = connections.get(conn_id)
+        if connection is None:
+            reader, writer = await asyncio.open_connection(host, port)
+            connection = connections[conn_id] = ReplayConnection(reader, writer)
+        connection.writer.write(frame)
+        connection.sent += 1
+        await connection.writer.drain()
+
+    elapsed = time.monotonic() - start[1] if start else 0.0
+    await asyncio.gather(*(c.close(drain_timeout) for c in connections.values()))
+
+    sent = sum(c.sent for c in connections.values())
+    received = sum(c.received for c in connections.values())
+    print(f"Replayed {sent} requests over {len(connections)} connections in {elapsed:.2f}s")
+    print(f"Responses received: {received} ({sent - received} missing)")
+    if speed:
+        print(f"Sent late (>1ms): {late}, worst {max_late * 1000:.1f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a Modbus MITM capture")
+    parser.add_argument('capture', help="capture file written with modbus_mitm.py --capture")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=MODBUS_TCP_PORT)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="time acceleration factor, 0 sends as fast as possible")
+    parser.add_argument('--drain-timeout', type=float, default=2.0,
+                        help="seconds to wait for outstanding responses at the end")
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(replay(args.capture, args.host, args.port, args.speed, args.drain_timeout))
+    except KeyboardInterrupt:
+        print("\nReplay interrupted")
+
+
+if __name__ == "__main__":
+    main()
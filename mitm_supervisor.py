@@ -0,0 +1,157 @@
+import os
+import signal
+import sys
+import time
+import traceback
+
+RESTART_DELAY = 0.5  # Seconds before restarting a worker that died young, doubled per further crash
+RESTART_MAX_DELAY = 30.0
+STABLE_SECONDS = 10.0  # A worker running this long resets the restart delay of its index
+
+
+class Supervisor:
+    """Fork worker processes, restart ones that die and roll them over on reload.
+
+    run_worker(index, workers, settings) runs in the child and returns when the worker is done.
+    load_settings() re-reads configuration on SIGHUP. If a setting in restart_keys changed, a new
+    generation of workers is started and the old one is sent SIGTERM to drain its connections;
+    otherwise SIGHUP is passed on so workers reload in place. Workers that keep dying young are restarted
+    with exponential backoff.
+    """
+
+    def __init__(self, run_worker, load_settings, settings, restart_keys, log):
+        self.run_worker = run_worker
+        self.load_settings = load_settings
+        self.settings = settings
+        self.restart_keys = restart_keys
+        self.log = log
+        self.workers = {}  # {pid: index} of current generation
+        self.retiring = set()  # pids of old generations still draining
+        self.started = {}  # {pid: monotonic start} of current generation
+        self.failures = {}  # {index: crashes in a row}
+        self.delayed = {}  # {index: monotonic time} of restarts waiting out their backoff
+        self.reload_requested = False
+        self.stopping = False
+
+    def spawn(self, index):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)  # supervisor turns Ctrl+C into SIGTERM
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGUSR1, signal.SIG_IGN)  # until the worker installs its own handlers
+                signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+                self.run_worker(index, self.settings['workers'], self.settings)
+                code = 0
+            except Exception:
+                self.log.error('!', "Worker %d (pid %d) failed:\n%s", index, os.getpid(),
+                               traceback.format_exc().rstrip())
+            finally:
+                self.log.close()
+                os._exit(code)
+        self.workers[pid] = index
+        self.started[pid] = time.monotonic()
+        return pid
+
+    def spawn_all(self):
+        for index in range(self.settings['workers']):
+            self.spawn(index)
+        self.log.info(None, "Started %d workers: %s", len(self.workers), sorted(self.workers))
+
+    def signal_all(self, signum, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reload(self):
+        try:
+            settings = self.load_settings()
+        except ValueError as e:
+            self.log.error('!', "Reload failed, keeping current config: %s", e)
+            return
+
+        changed = [key for key in self.restart_keys if settings.get(key) != self.settings.get(key)]
+        self.settings = settings
+        if changed:
+            self.log.info(None, "Reload changed %s, replacing workers", ", ".join(changed))
+            old = list(self.workers)
+            self.retiring.update(old)
+            self.workers = {}
+            self.failures.clear()
+            self.delayed.clear()
+            self.spawn_all()
+            self.signal_all(signal.SIGTERM, old)
+        else:
+            self.log.info(None, "Reloading workers in place")
+            self.signal_all(signal.SIGHUP, self.workers)
+
+    def reap(self):
+        """Collect exited workers, restart current ones that died unexpectedly"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            index = self.workers.pop(pid, None)
+            started = self.started.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            if started is not None and time.monotonic() - started >= STABLE_SECONDS:
+                self.failures[index] = 0
+            failures = self.failures[index] = self.failures.get(index, 0) + 1
+            delay = min(RESTART_DELAY * 2 ** (failures - 1), RESTART_MAX_DELAY)
+            self.log.warning('!', "Worker %d (pid %d) exited with status %d, restarting in %.1fs",
+                             index, pid, os.waitstatus_to_exitcode(status), delay)
+            self.delayed[index] = time.monotonic() + delay
+
+    def restart_due(self):
+        """Restart workers whose backoff has passed"""
+        now = time.monotonic()
+        for index, due in list(self.delayed.items()):
+            if due <= now:
+                del self.delayed[index]
+                self.spawn(index)
+
+    def run(self):
+        """Supervise until SIGINT/SIGTERM, then stop workers and wait for them to drain"""
+
+        def request_reload(signum, frame):
+            self.reload_requested = True
+
+        def request_stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            # Profiling requests apply to every current worker
+            signal.signal(signum, lambda signum, frame: self.signal_all(signum, list(self.workers)))
+
+        self.spawn_all()
+        while not self.stopping:
+            time.sleep(0.2)
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            self.restart_due()
+
+        self.log.info(None, "Stopping %d workers", len(self.workers) + len(self.retiring))
+        self.signal_all(signal.SIGTERM, list(self.workers) + list(self.retiring))
+        for pid in list(self.workers) + list(self.retiring):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
